@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+from states import HierarchicalState
+from states import ConcurrentState
+from states import Statechart
+from pseudostates import HistoryState
+
+class ValidationError(Exception):
+    pass
+
+class Analysis(object):
+
+    """
+        Static checks of a built statechart:
+
+        unreachable     states that no sequence of events can enter
+        shadowed        transitions that never fire, an unguarded transition
+                        of their state being tried before them for every
+                        event they match, see State.add_transition
+        missing_start   statecharts with substates, regions, hierarchical
+                        states with substates or the target of a transition,
+                        without a start state
+        history         (history state, problem) pairs, the misuse that
+                        HistoryState.activate asserts on
+
+        tables() holds the dispatch indexes without the transitions that can
+        never fire, prune() installs them in the states.
+    """
+
+    def __init__(self, statechart):
+        self.statechart = statechart
+        self.states = self.collect(statechart)
+
+        targets = set()
+        for state in self.states:
+            targets.update([t.end for t in state.transitions])
+
+        self.missing_start = [state for state in self.states
+                              if self.needs_start(state, targets)]
+
+        self.history = []
+        for state in self.states:
+            if isinstance(state, HistoryState):
+                self.history.extend([(state, problem) for problem
+                                     in self.check_history(state)])
+
+        self.unreachable = self.find_unreachable()
+
+        self.pruned = {}
+        self.shadowed = []
+        for state in self.states:
+            self.pruned[state] = self.prune_state(state)
+
+    def needs_start(self, state, targets):
+        """ Deferred substates come with their start state """
+        if (not isinstance(state, (HierarchicalState, Statechart)) or
+            state.start_state or state.factory != None):
+            return False
+
+        return bool(state.substates or state in targets or
+                    isinstance(state.context, ConcurrentState))
+
+    def collect(self, statechart):
+        states = []
+        pending = [statechart]
+        while pending:
+            state = pending.pop()
+            states.append(state)
+            pending.extend(reversed(getattr(state, 'substates', ())))
+
+        return states
+
+    def check_history(self, state):
+        if len(state.transitions) != 1:
+            return ["%d transitions instead of one to the default state" %
+                    len(state.transitions)]
+
+        transition = state.transitions[0]
+        if transition.deactivate != [state]:
+            return ["default transition leaves %s" % state.context]
+
+        if transition.event != None or transition.guard != None:
+            return ["default transition has an event or a guard"]
+
+        return []
+
+    def find_unreachable(self):
+        reached = set([self.statechart])
+        pending = [self.statechart]
+
+        while pending:
+            state = pending.pop()
+
+            """ Entered states: the lazy start, the regions, the targets """
+            entered = []
+            if getattr(state, 'start_state', None):
+                entered.append(state.start_state)
+
+            if isinstance(state, ConcurrentState):
+                entered.extend(state.regions)
+
+            for transition in state.transitions:
+                entered.extend(transition.activate)
+
+            for s in entered:
+                if s not in reached:
+                    reached.add(s)
+                    pending.append(s)
+
+        return [state for state in self.states if state not in reached]
+
+    def prune_state(self, state):
+        """ 
+            The candidates of each event up to the first unguarded one, from
+            all the transitions of the state whatever index it has now
+        """
+        candidates, eventless = state.dispatch_tables()
+
+        live = set()
+        index = {}
+        for key, transitions in candidates.items():
+            index[key] = self.cut(transitions)
+            live.update(index[key])
+
+        eventless = self.cut(eventless)
+        live.update(eventless)
+
+        self.shadowed.extend([transition for transition in state.transitions
+                              if transition not in live])
+        return index, eventless
+
+    def cut(self, candidates):
+        for i, transition in enumerate(candidates):
+            if transition.guard == None:
+                return candidates[:i + 1]
+
+        return list(candidates)
+
+    def tables(self):
+        """ State to (event id to candidates, eventless candidates) """
+        return self.pruned
+
+    def prune(self):
+        """ Has the interpreter and compile() use the pruned indexes """
+        assert self.statechart.compiled == None,\
+            "Statechart already compiled"
+
+        for state, (index, eventless) in self.pruned.items():
+            state.dispatch_index = index
+            state.eventless_transitions = eventless
+
+    def errors(self):
+        """ The problems that make the statechart fail while running """
+        report = []
+        for state in self.missing_start:
+            report.append("%s has no start state" % state)
+
+        for state, problem in self.history:
+            report.append("History state %s: %s" % (state, problem))
+
+        return report
+
+    def problems(self):
+        report = self.errors()
+        for state in self.unreachable:
+            report.append("%s is unreachable" % state)
+
+        for transition in self.shadowed:
+            report.append("Transition from %s to %s on %s never fires" %
+                          (transition.start, transition.end,
+                           transition.event))
+
+        return report
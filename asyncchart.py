@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+""" Requires Python 3.7 or later """
+
+import asyncio
+import contextvars
+import inspect
+
+from compiled import CONCURRENT
+from compiled import START
+from compiled import HISTORY
+from compiled import PSEUDO
+from transition import Event
+from transition import cached_guard
+from eventqueue import EventQueue
+from eventqueue import RAISE
+from profiling import clock
+from profiling import notify_action
+from profiling import notify_dispatched
+from profiling import notify_guard
+
+""" 
+    The statecharts handling an event in the current context. The tasks of
+    parallel regions and those started by the actions inherit it.
+"""
+processing = contextvars.ContextVar('processing', default=())
+
+async def complete(result):
+    """ Actions and guards may return an awaitable, it is waited for """
+    if inspect.isawaitable(result):
+        return await result
+
+    return result
+
+class AsyncStatechart(object):
+
+    """
+        Runs a compiled statechart on an asyncio event loop. Events are put
+        on a queue and handled one at a time, each to completion, so the
+        actions and guards may be coroutines without another event being
+        dispatched while they are suspended. Synchronous actions and guards
+        work unchanged.
+
+        The steps of the compiled executor are shared, see
+        CompiledStatechart.begin and the methods after it, so the listeners,
+        the timed transitions, the pure guard cache and the journal trace
+        work as with StatechartInstance. An event that fails raises from
+        its dispatch() and the queue is still drained; failures of events
+        posted by the actions are kept in failures as (event, exception).
+
+        queue_size and overflow bound the queue, see eventqueue.EventQueue,
+        the dispatch of a dropped event returns that it was not handled.
+    """
+
+    def __init__(self, compiled, param, queue_size=None, overflow=RAISE):
+        self.compiled = compiled
+        self.param = param
+        self.runtime = None
+        self.queue = EventQueue(queue_size, overflow)
+        self.task = None
+        self.failures = []
+
+    async def start(self):
+        if self.runtime and self.runtime.timers:
+            self.runtime.timers.clear()
+
+        self.queue.clear()
+        self.runtime = self.compiled.new_runtime(self.expire)
+        self.compiled.reset(self.runtime)
+        await self.dispatch(None)
+
+    def expire(self, event):
+        """ Called by the timing wheel, which runs on the event loop """
+        asyncio.ensure_future(self.dispatch(event))
+
+    def param_changed(self):
+        """ To call when the param is changed from outside of the actions """
+        self.runtime.param_changed()
+
+    def post(self, event):
+        """ Queues an event, meant for actions of the running statechart """
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        self.put(event, None)
+
+    def put(self, event, future):
+        dropped = self.queue.put((event, future))
+
+        """ The dispatch of a dropped event returns that it was not handled """
+        if dropped and dropped[1]:
+            dropped[1].set_result(False)
+
+    async def dispatch(self, event):
+        """
+            Queues the event and returns whether it was handled. A dispatch
+            from an action of the statechart only queues the event.
+        """
+        if self.task is not None and self in processing.get():
+            self.post(event)
+            return None
+
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        future = asyncio.get_event_loop().create_future()
+        self.put(event, future)
+
+        if self.task is None:
+            await self.process()
+
+        return await future
+
+    async def process(self):
+        self.task = asyncio.current_task()
+        token = processing.set(processing.get() + (self,))
+        try:
+            while self.queue:
+                event, future = self.queue.get()
+                try:
+                    id = await self.run(self.runtime, event)
+                except Exception as e:
+                    """ The events queued after it are still handled """
+                    if future is None:
+                        self.failures.append((event, e))
+                    else:
+                        future.set_exception(e)
+                else:
+                    if future is not None:
+                        future.set_result(id != -1)
+        finally:
+            processing.reset(token)
+            self.task = None
+
+    async def run(self, runtime, event, segment=None):
+        """ See CompiledStatechart.dispatch """
+        if segment == None:
+            if runtime.listeners:
+                start = clock()
+                id = await self.run(runtime, event, 0)
+                notify_dispatched(runtime, event, clock() - start)
+                return id
+            segment = 0
+
+        compiled = self.compiled
+        kinds = compiled.kinds
+        states = compiled.states
+
+        while True:
+            state = states[runtime.leaves[segment]]
+            kind = kinds[state.state_id]
+
+            start = compiled.unstarted(runtime, state, kind)
+            if start:
+                runtime.activate(start)
+                await self.enter_initial(runtime, start)
+                continue
+
+            break
+
+        if kind == CONCURRENT:
+            fired = -1
+            if state.parallel:
+                regions = [region for region in state.regions
+                           if runtime.is_active(region)]
+                forks = [runtime.fork() for region in regions]
+                ids = await asyncio.gather(*[self.run(fork, event,
+                                        compiled.segments[region.state_id])
+                                             for region, fork
+                                             in zip(regions, forks)])
+                runtime.join(forks)
+                for id in ids:
+                    if fired == -1:
+                        fired = id
+            else:
+                for region in state.regions:
+                    if runtime.is_active(region):
+                        id = await self.run(runtime, event,
+                                            compiled.segments[region.state_id])
+                        if fired == -1:
+                            fired = id
+
+            if fired != -1:
+                return fired
+
+        for transition in compiled.candidates(state, event):
+            if await self.fire(runtime, transition, event):
+                return transition.id
+
+        return -1
+
+    async def check(self, runtime, transition, guard):
+        """ See transition.check_guard """
+        start = clock()
+        version = runtime.version
+
+        cached = None
+        if guard.pure:
+            cached = cached_guard(guard, runtime)
+
+        if cached != None:
+            result = cached[0]
+        else:
+            result = await complete(guard.check(runtime, self.param))
+            if guard.pure:
+                runtime.guards[guard] = (version, result)
+
+        if runtime.listeners:
+            notify_guard(runtime, transition.transition, result,
+                         clock() - start)
+
+        return result
+
+    async def execute(self, runtime, owner, action):
+        start = clock()
+        await complete(action.execute(self.param))
+
+        if runtime.listeners:
+            notify_action(runtime, owner, action, clock() - start)
+
+    async def fire(self, runtime, transition, event):
+        guard = transition.guard
+        if guard and not await self.check(runtime, transition, guard):
+            return False
+
+        outer = self.compiled.begin(runtime, transition, event)
+
+        for state in transition.exits:
+            await self.exit(runtime, state)
+
+        if transition.action:
+            await self.execute(runtime, transition.transition,
+                               transition.action)
+
+        for state in transition.enters:
+            await self.enter(runtime, state)
+
+        if transition.initial:
+            await self.enter_initial(runtime, transition.initial)
+
+        runtime.transition, runtime.event = outer
+
+        return True
+
+    async def enter_initial(self, runtime, state):
+        for transition in self.compiled.initials[state.state_id]:
+            if await self.fire(runtime, transition, None):
+                return
+
+    async def enter(self, runtime, state):
+        compiled = self.compiled
+        kind = compiled.kinds[state.state_id]
+
+        if kind == START:
+            await self.enter_initial(runtime, state)
+
+        elif kind == HISTORY:
+            if runtime.has_history_info(state):
+                await self.enter(runtime, runtime.get_history_state(state))
+            else:
+                await self.enter_initial(runtime, state)
+
+        elif kind == PSEUDO:
+            runtime.activate(state)
+
+        elif not runtime.is_active(state):
+            compiled.activated(runtime, state)
+
+            if state.entry:
+                await self.execute(runtime, state, state.entry)
+
+            if state.do:
+                await self.execute(runtime, state, state.do)
+
+            regions = compiled.entered(runtime, state, kind)
+            if regions and state.parallel:
+                forks = [runtime.fork() for region in regions]
+                await asyncio.gather(*[self.enter_region(fork, region)
+                                       for region, fork
+                                       in zip(regions, forks)])
+                runtime.join(forks)
+            else:
+                for region in regions:
+                    await self.enter_region(runtime, region)
+
+    async def enter_region(self, runtime, region):
+        await self.enter(runtime, region)
+        await self.enter_initial(runtime, region.start_state)
+
+    async def exit(self, runtime, state):
+        if not runtime.is_active(state):
+            return
+
+        compiled = self.compiled
+        for substate in compiled.exiting(runtime, state,
+                                         compiled.kinds[state.state_id]):
+            await self.exit(runtime, substate)
+
+        if state.exit:
+            await self.execute(runtime, state, state.exit)
+
+        compiled.exited(runtime, state)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+"""
+    Benchmarks of the dispatch throughput and of the construction of the
+    statecharts, on synthetic charts. The results are written as JSON and
+    can be compared with a stored baseline:
+
+        python benchmarks.py --output baseline.json
+        python benchmarks.py --baseline baseline.json
+"""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+
+from profiling import clock
+from states import State
+from states import HierarchicalState
+from states import ConcurrentState
+from states import Statechart
+from states import Transition
+from pseudostates import StartState
+from transition import Event
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+""" Relative change tolerated by the baseline comparison """
+TOLERANCE       = 0.10
+
+def build_region(context, width, depth, leaves):
+    start = StartState(context)
+    children = []
+
+    for i in range(width):
+        if depth > 1:
+            child = HierarchicalState(context, None, None, None)
+            build_region(child, width, depth - 1, leaves)
+        else:
+            child = State(context, None, None, None)
+            leaves.append(child)
+        children.append(child)
+
+    Transition(start, children[0], None, None, None)
+
+def build_chart(width=4, depth=3, regions=1, fanout=2, events=16, seed=0):
+    """
+        A chart whose regions are trees of hierarchical states, width
+        substates per level and depth levels. Every leaf gets fanout
+        transitions on random events to random leaves of its region.
+        Returns the statechart and the event ids it handles.
+    """
+    rng = random.Random(seed)
+    statechart = Statechart(None)
+    start = StartState(statechart)
+
+    if regions > 1:
+        top = ConcurrentState(statechart, None, None, None)
+        contexts = [HierarchicalState(top, None, None, None)
+                    for i in range(regions)]
+    else:
+        top = HierarchicalState(statechart, None, None, None)
+        contexts = [top]
+
+    Transition(start, top, None, None, None)
+
+    for context in contexts:
+        leaves = []
+        build_region(context, width, depth, leaves)
+
+        for leaf in leaves:
+            for i in range(fanout):
+                Transition(leaf, rng.choice(leaves),
+                           Event(rng.randrange(events)), None, None)
+
+    return statechart, list(range(events))
+
+def transitions_of(statechart):
+    states = [statechart]
+    transitions = []
+
+    while states:
+        state = states.pop()
+        transitions.extend(state.transitions)
+        states.extend(getattr(state, 'substates', ()))
+
+    return transitions
+
+def best_of(repeat, function):
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        start = clock()
+        function()
+        elapsed = clock() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+def measure_memory(compiled, instances):
+    """ Bytes allocated per started instance, None without tracemalloc """
+    if tracemalloc == None:
+        return None
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        population = [compiled.spawn(None) for i in range(instances)]
+        for instance in population:
+            instance.start()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return (after - before) / float(instances)
+
+def run(width=4, depth=3, regions=1, fanout=2, events=16, count=20000,
+        repeat=3, seed=0, instances=1000):
+    results = {}
+    stream = random.Random(seed + 1)
+    event_ids = [stream.randrange(events) for i in range(count)]
+
+    build = lambda: build_chart(width, depth, regions, fanout, events, seed)
+    results['build_seconds'] = best_of(repeat, build)
+
+    statechart, ids = build()
+    transitions = transitions_of(statechart)
+    results['transitions'] = len(transitions)
+
+    def changed_states():
+        for transition in transitions:
+            transition.activate = []
+            transition.deactivate = []
+            transition.calculate_changed_states(transition.start,
+                                                transition.end)
+
+    results['changed_states_seconds'] = (best_of(repeat, changed_states) /
+                                         len(transitions))
+
+    results['interpreted_start_seconds'] = best_of(repeat, statechart.start)
+    interpreted = best_of(repeat,
+                          lambda: [statechart.dispatch(id) for id in event_ids])
+    results['interpreted_events_per_second'] = count / interpreted
+
+    statechart, ids = build()
+    start = clock()
+    compiled = statechart.compile()
+    results['compile_seconds'] = clock() - start
+
+    results['compiled_start_seconds'] = best_of(repeat, statechart.start)
+    dispatch = best_of(repeat,
+                       lambda: [statechart.dispatch(id) for id in event_ids])
+    results['compiled_events_per_second'] = count / dispatch
+
+    events_objects = [Event.get(id) for id in event_ids]
+    batch = best_of(repeat, lambda: statechart.dispatch_many(events_objects))
+    results['batch_events_per_second'] = count / batch
+
+    """ Latency of single dispatches, the clock overhead included """
+    samples = []
+    for event in events_objects:
+        start = clock()
+        statechart.dispatch(event)
+        samples.append(clock() - start)
+
+    results['latency_p50_seconds'] = percentile(samples, 50)
+    results['latency_p99_seconds'] = percentile(samples, 99)
+    results['instance_bytes'] = measure_memory(compiled, instances)
+
+    return results
+
+def lower_is_better(name):
+    return not name.endswith('_per_second')
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Returns (name, baseline, result, change, regressed) tuples """
+    report = []
+    for name in sorted(results):
+        old = baseline.get(name)
+        new = results[name]
+        if old in (None, 0) or new == None or name == 'transitions':
+            continue
+
+        change = (new - old) / float(old)
+        if lower_is_better(name):
+            regressed = change > tolerance
+        else:
+            regressed = change < -tolerance
+
+        report.append((name, old, new, change, regressed))
+
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                    description="Statechart dispatch and build benchmarks")
+    parser.add_argument('--width', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--regions', type=int, default=1)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--events', type=int, default=16,
+                        help="number of distinct events")
+    parser.add_argument('--count', type=int, default=20000,
+                        help="events dispatched per measurement")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with these results")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    config = dict(width=args.width, depth=args.depth, regions=args.regions,
+                  fanout=args.fanout, events=args.events, count=args.count,
+                  seed=args.seed)
+    results = run(repeat=args.repeat, **config)
+
+    document = {'python': platform.python_version(), 'config': config,
+                'results': results}
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as input:
+        baseline = json.load(input)
+
+    if baseline.get('config') != config:
+        sys.stderr.write("Baseline taken with another configuration\n")
+
+    regressions = 0
+    for name, old, new, change, regressed in compare(results,
+                                    baseline['results'], args.tolerance):
+        regressions += regressed
+        sys.stderr.write("%-32s %12.4g %12.4g %+7.1f%%%s\n" % (name, old, new,
+                         change * 100, "  REGRESSION" if regressed else ""))
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
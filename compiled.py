@@ -0,0 +1,727 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+from array import array
+
+from runtime import CompactRuntimeData
+from eventqueue import EventQueue
+from eventqueue import RAISE
+from snapshot import SnapshotFormat
+from states import HierarchicalState
+from states import ConcurrentState
+from states import Statechart
+from transition import Event
+from transition import check_guard
+from timers import Timers
+from profiling import notify_entered
+from profiling import notify_exited
+from profiling import notify_fired
+from profiling import observe_action
+from profiling import observe_dispatch
+from profiling import observe_guard
+from pseudostates import StartState
+from pseudostates import HistoryState
+from pseudostates import PseudoState
+
+""" State kinds, these replace the isinstance checks while dispatching """
+SIMPLE          = 0
+HIERARCHICAL    = 1
+CONCURRENT      = 2
+START           = 3
+HISTORY         = 4
+PSEUDO          = 5
+CHART           = 6
+
+def state_kind(state):
+    if isinstance(state, Statechart):
+        return CHART
+    if isinstance(state, HierarchicalState):
+        return HIERARCHICAL
+    if isinstance(state, ConcurrentState):
+        return CONCURRENT
+    if isinstance(state, StartState):
+        return START
+    if isinstance(state, HistoryState):
+        return HISTORY
+    if isinstance(state, PseudoState):
+        return PSEUDO
+    return SIMPLE
+
+class CompiledTransition(object):
+
+    __slots__ = ('id', 'transition', 'guard', 'action',
+                 'exits', 'enters', 'initial')
+
+    def __init__(self, id, transition, kinds):
+        self.id = id
+        self.transition = transition
+        self.guard = transition.guard
+        self.action = transition.action
+        self.exits = tuple(transition.deactivate)
+        self.enters = tuple(transition.activate)
+
+        """
+            The target of the transition is the only state that gets entered
+            through its start state, see HierarchicalState.activate
+        """
+        end = transition.end
+        self.initial = None
+        if (self.enters and kinds[end.state_id] == HIERARCHICAL):
+            self.initial = end.start_state
+
+class StatechartInstance(object):
+
+    """
+        A run of a compiled statechart. Instances share the states and the
+        transitions of the statechart and only own the parameter, the
+        runtime data and the queue of posted events, bounded by queue_size
+        and overflow, see eventqueue.EventQueue.
+    """
+
+    __slots__ = ('compiled', 'param', 'runtime', 'queue', 'dispatching')
+
+    def __init__(self, compiled, param, queue_size=None, overflow=RAISE):
+        self.compiled = compiled
+        self.param = param
+        self.runtime = None
+        self.queue = EventQueue(queue_size, overflow)
+        self.dispatching = False
+
+    def start(self):
+        if self.runtime and self.runtime.timers:
+            self.runtime.timers.clear()
+
+        self.queue.clear()
+        self.runtime = self.compiled.new_runtime(self.dispatch)
+
+        self.dispatching = True
+        try:
+            self.compiled.start(self.runtime, self.param)
+            self.compiled.drain(self.runtime, self.queue, self.param)
+        finally:
+            self.dispatching = False
+
+    def post(self, event):
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        self.queue.put(event)
+
+    def dispatch(self, event):
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        if self.dispatching:
+            self.queue.put(event)
+            return False
+
+        self.dispatching = True
+        try:
+            id = self.compiled.dispatch(self.runtime, event, self.param)
+            self.compiled.drain(self.runtime, self.queue, self.param)
+        finally:
+            self.dispatching = False
+
+        return id != -1
+
+    def dispatch_many(self, events):
+        """ See Statechart.dispatch_many """
+        if self.dispatching:
+            raise RuntimeError("Batch dispatch from an action")
+
+        self.dispatching = True
+        try:
+            return self.compiled.dispatch_many(self.runtime, events,
+                                               self.param, self.queue)
+        finally:
+            self.dispatching = False
+
+    def dispatch_stream(self, events):
+        """ See Statechart.dispatch_stream """
+        if self.dispatching:
+            raise RuntimeError("Batch dispatch from an action")
+
+        return self.stream(self.compiled.dispatch_stream(self.runtime, events,
+                                                         self.param,
+                                                         self.queue))
+
+    def stream(self, stream):
+        """ See Statechart.stream """
+        while True:
+            dispatching = self.dispatching
+            if dispatching:
+                raise RuntimeError("Batch dispatch from an action")
+
+            self.dispatching = True
+            try:
+                id = next(stream)
+            except StopIteration:
+                return
+            finally:
+                self.dispatching = dispatching
+
+            yield id
+
+    def snapshot(self):
+        return self.compiled.snapshots.snapshot(self.runtime)
+
+    def param_changed(self):
+        """ To call when the param is changed from outside of the actions """
+        self.runtime.param_changed()
+
+    def is_in(self, state):
+        """ Whether state is in the active configuration """
+        return self.runtime.is_active(state)
+
+    def active_leaves(self):
+        """ The innermost active states, an iterator over the runtime """
+        return self.runtime.active_leaves()
+
+    def changes(self, raw=False):
+        """ 
+            The (exited, entered) states since the previous call, to call
+            after every dispatch. Tracking starts with the first call.
+
+            The changes are netted: a state exited and entered again, by a
+            self transition or the exit of an ancestor, is in neither list.
+            With raw set, both lists hold every exit and entry, in the order
+            they happened.
+        """
+        return self.runtime.take_changes(raw)
+
+    def restore(self, data):
+        """ 
+            Resumes from a snapshot, without running any entry action. The
+            timed transitions of the active states start over.
+        """
+        if self.runtime == None:
+            self.runtime = self.compiled.new_runtime(self.dispatch)
+
+        self.queue.clear()
+        self.compiled.snapshots.read(self.runtime, data)
+        self.compiled.rearm(self.runtime)
+
+    def shutdown(self):
+        pass
+
+class CompiledStatechart(object):
+
+    """
+        Flat representation of a statechart. States are numbered in pre-order
+        starting with the statechart itself, so a parent always has a lower
+        id than its substates. For every state the candidate transitions of
+        the state and its ancestors, up to the enclosing region or the
+        statechart, are kept in one table so that dispatch does a single
+        lookup instead of recursing through the hierarchy.
+    """
+
+    def __init__(self, statechart):
+        self.statechart = statechart
+        self.states = []
+        self.kinds = []
+        self.parents = []
+        self.transitions = []
+
+        self.number_states(statechart)
+        self.number_transitions()
+
+        """ 
+            Index of the statechart or region whose current configuration
+            includes the state, 0 being the statechart. The deepest active
+            state of a segment is the state that was activated last in it,
+            see CompactRuntimeData.leaves.
+        """
+        roots = {}
+        self.segments = []
+        self.roots = []
+        for state in self.states:
+            root = self.segment(state)
+            self.roots.append(root)
+            if root not in roots:
+                roots[root] = len(roots)
+            self.segments.append(roots[root])
+        self.segment_count = len(roots)
+
+        """ Index of each history state in CompactRuntimeData.history """
+        self.histories = [-1] * len(self.states)
+        self.history_states = []
+        for state in self.states:
+            if self.kinds[state.state_id] == HISTORY:
+                self.histories[state.state_id] = len(self.history_states)
+                self.history_states.append(state)
+
+        """ Own eventless transitions, used when entering pseudostates """
+        self.initials = []
+
+        """ Event id to candidate transitions, per state """
+        self.tables = []
+
+        """ Candidate transitions for events that are not in the table """
+        self.eventless = []
+
+        for state in self.states:
+            self.initials.append(self.compile_transitions(
+                                    state.get_transitions(None)))
+            self.compile_table(state)
+
+        self.timed_states = [state for state in self.states if state.timeouts]
+
+        self.snapshots = SnapshotFormat(self)
+
+    def number_states(self, statechart):
+        pending = [statechart]
+        while pending:
+            state = pending.pop()
+            if getattr(state, 'factory', None) != None:
+                """ The tables cover the whole statechart """
+                state.materialize()
+
+            state.state_id = len(self.states)
+            self.states.append(state)
+            self.kinds.append(state_kind(state))
+
+            if state.context == None:
+                self.parents.append(-1)
+            else:
+                self.parents.append(state.context.state_id)
+
+            substates = getattr(state, 'substates', ())
+            pending.extend(reversed(substates))
+
+    def number_transitions(self):
+        for state in self.states:
+            for transition in state.transitions:
+                transition.transition_id = len(self.transitions)
+                self.transitions.append(CompiledTransition(
+                    transition.transition_id, transition, self.kinds))
+
+    def segment(self, state):
+        """ Id of the segment root, the parent's is known by then """
+        parent = self.parents[state.state_id]
+        if parent == -1:
+            return state.state_id
+
+        kind = self.kinds[parent]
+        if kind == HIERARCHICAL:
+            return self.roots[parent]
+
+        if kind == CHART:
+            return parent
+
+        return state.state_id
+
+    def compile_transitions(self, transitions):
+        compiled = self.transitions
+        return tuple([compiled[t.transition_id] for t in transitions])
+
+    def compile_table(self, state):
+        if state.context == None:
+            self.tables.append({})
+            self.eventless.append(())
+            return
+
+        """ 
+            The candidates of the state come first, then those of the parent
+            when it dispatches the events of its substates too. The table of
+            the parent already holds the rest of the chain, so every state is
+            merged once.
+        """
+        parent = self.parents[state.state_id]
+        if self.kinds[parent] == HIERARCHICAL:
+            inherited = self.tables[parent]
+            inherited_eventless = self.eventless[parent]
+        else:
+            inherited = {}
+            inherited_eventless = ()
+
+        state.get_transitions(None)
+        eventless = self.compile_transitions(state.eventless_transitions)
+
+        table = {}
+        for key, transitions in state.dispatch_index.items():
+            table[key] = (self.compile_transitions(transitions) +
+                          inherited.get(key, inherited_eventless))
+
+        for key, transitions in inherited.items():
+            if key not in table:
+                table[key] = eventless + transitions
+
+        self.tables.append(table)
+        self.eventless.append(eventless + inherited_eventless)
+
+    def start(self, runtime, param):
+        self.reset(runtime)
+        self.dispatch(runtime, None, param)
+
+    def reset(self, runtime):
+        """ The configuration before the start, only the statechart active """
+        statechart = self.statechart
+
+        runtime.reset()
+        runtime.activate(statechart)
+        runtime.activate(statechart.start_state)
+
+    def new_runtime(self, dispatch=None):
+        """ dispatch(event) runs the timed transitions, see timers.Timers """
+        runtime = CompactRuntimeData(self)
+        runtime.listeners = self.statechart.listeners
+
+        wheel = self.statechart.timing_wheel
+        if wheel != None and dispatch != None:
+            runtime.timers = Timers(wheel, dispatch)
+
+        return runtime
+
+    def rearm(self, runtime):
+        """ Arms the timers of the active states again, after a restore """
+        if runtime.timers == None:
+            return
+
+        runtime.timers.clear()
+        for state in self.timed_states:
+            if runtime.is_active(state):
+                runtime.timers.arm(state)
+
+    def spawn(self, param, queue_size=None, overflow=RAISE):
+        return StatechartInstance(self, param, queue_size, overflow)
+
+    def dispatch(self, runtime, event, param, segment=None):
+        """ 
+            Dispatches the event to the segment, by default the statechart,
+            returns the id of the first transition fired or -1
+        """
+        if segment == None:
+            if runtime.listeners:
+                return observe_dispatch(runtime, event, self.dispatch,
+                                        runtime, event, param, 0)
+            segment = 0
+
+        kinds = self.kinds
+        states = self.states
+        leaves = runtime.leaves
+
+        while True:
+            state = states[leaves[segment]]
+            kind = kinds[state.state_id]
+
+            if kind == HIERARCHICAL:
+                start = self.unstarted(runtime, state, kind)
+                if start:
+                    runtime.activate(start)
+                    self.enter_initial(runtime, start, param)
+                    continue
+
+            break
+
+        if kind == CONCURRENT:
+            fired = -1
+            if state.executor:
+                regions = [region for region in state.regions
+                           if runtime.is_active(region)]
+                forks = [runtime.fork() for region in regions]
+                results = [state.executor.apply_async(self.dispatch,
+                                (fork, event, param,
+                                 self.segments[region.state_id]))
+                           for region, fork in zip(regions, forks)]
+
+                for result in results:
+                    id = result.get()
+                    if fired == -1:
+                        fired = id
+
+                runtime.join(forks)
+            else:
+                for region in state.regions:
+                    if runtime.is_active(region):
+                        id = self.dispatch(runtime, event, param,
+                                           self.segments[region.state_id])
+                        if fired == -1:
+                            fired = id
+
+            if fired != -1:
+                return fired
+
+        for transition in self.candidates(state, event):
+            if self.fire(runtime, transition, event, param):
+                return transition.id
+
+        return -1
+
+    """
+        Steps shared with asyncchart.AsyncStatechart, which runs the same
+        executor but waits for the actions and guards. dispatch, enter and
+        exit inline the cheapest of them.
+    """
+
+    def unstarted(self, runtime, state, kind):
+        """ The start state of a leaf entered without it, see dispatch """
+        if (kind == HIERARCHICAL and state.start_state and
+            not runtime.is_active(state.start_state)):
+            return state.start_state
+
+        return None
+
+    def candidates(self, state, event):
+        if event is None:
+            return self.eventless[state.state_id]
+
+        return self.tables[state.state_id].get(event.id,
+                                               self.eventless[state.state_id])
+
+    def begin(self, runtime, transition, event):
+        """ 
+            Bookkeeping of a transition about to fire, returns the outer
+            transition and event, to restore once it has fired: entering a
+            start state fires transitions within this one. The actions may
+            change the param.
+        """
+        runtime.version += 1
+
+        if runtime.trace is not None:
+            runtime.trace.append(transition.id)
+
+        if runtime.listeners:
+            notify_fired(runtime, transition.transition)
+
+        outer = (runtime.transition, runtime.event)
+        runtime.event = event
+        runtime.transition = transition.transition
+        return outer
+
+    def activated(self, runtime, state):
+        """ Before the entry actions """
+        runtime.activate(state)
+
+        if runtime.listeners:
+            notify_entered(runtime, state)
+
+    def entered(self, runtime, state, kind):
+        """ After the entry actions, returns the regions to enter """
+        if state.timeouts and runtime.timers:
+            runtime.timers.arm(state)
+
+        if kind != CONCURRENT:
+            return ()
+
+        """ The region a transition enters explicitly is left to it """
+        if runtime.transition:
+            return [region for region in state.regions
+                    if region not in runtime.transition.activate]
+
+        return state.regions
+
+    def exiting(self, runtime, state, kind):
+        """ Before the substates are exited, returns them """
+        if state.timeouts and runtime.timers:
+            runtime.timers.cancel(state)
+
+        if kind == HIERARCHICAL:
+            current_state = runtime.get_current_state(state)
+            if state.history:
+                runtime.store_history_info(state.history, current_state)
+
+            if current_state != None:
+                return (current_state,)
+
+        elif kind == CONCURRENT:
+            return state.regions
+
+        return ()
+
+    def exited(self, runtime, state):
+        """ After the exit action """
+        runtime.deactivate(state)
+
+        if runtime.listeners:
+            notify_exited(runtime, state)
+
+    def drain(self, runtime, queue, param):
+        """ Dispatches the events posted by the actions """
+        while queue:
+            self.dispatch(runtime, queue.get(), param)
+
+    def dispatch_many(self, runtime, events, param, queue=None):
+        """ 
+            Dispatches the events in turn, returns an array holding for every
+            event the id of the transition fired or -1. Events posted to the
+            queue are dispatched after each event.
+        """
+        results = array('i')
+        append = results.append
+        dispatch = self.dispatch
+        fire = self.fire
+        get = Event.get
+        kinds = self.kinds
+        tables = self.tables
+        eventless = self.eventless
+        leaves = runtime.leaves
+        listeners = runtime.listeners
+
+        for event in events:
+            if event is not None and not isinstance(event, Event):
+                event = get(event)
+
+            """ 
+                Composite leaves need the lazy start or the regions, the
+                listeners time the dispatches
+            """
+            id = leaves[0]
+            kind = kinds[id]
+            if kind == HIERARCHICAL or kind == CONCURRENT or listeners:
+                append(dispatch(runtime, event, param))
+                if queue:
+                    self.drain(runtime, queue, param)
+                continue
+
+            if event is None:
+                candidates = eventless[id]
+            else:
+                candidates = tables[id].get(event.id, eventless[id])
+
+            for transition in candidates:
+                if fire(runtime, transition, event, param):
+                    append(transition.id)
+                    break
+            else:
+                append(-1)
+
+            if queue:
+                self.drain(runtime, queue, param)
+
+        return results
+
+    def dispatch_stream(self, runtime, events, param, queue=None):
+        """ Same as dispatch_many, yields the result as each event is handled """
+        dispatch = self.dispatch
+        get = Event.get
+
+        for event in events:
+            if event is not None and not isinstance(event, Event):
+                event = get(event)
+
+            id = dispatch(runtime, event, param)
+            if queue:
+                self.drain(runtime, queue, param)
+
+            yield id
+
+    def fire(self, runtime, transition, event, param):
+        listeners = runtime.listeners
+
+        guard = transition.guard
+        if guard:
+            if listeners:
+                if not observe_guard(runtime, transition.transition, guard,
+                                     param):
+                    return False
+            elif not check_guard(guard, runtime, param):
+                return False
+
+        outer = self.begin(runtime, transition, event)
+
+        for state in transition.exits:
+            self.exit(runtime, state, param)
+
+        if transition.action:
+            if listeners:
+                observe_action(runtime, transition.transition,
+                               transition.action, param)
+            else:
+                transition.action.execute(param)
+
+        for state in transition.enters:
+            self.enter(runtime, state, param)
+
+        if transition.initial:
+            self.enter_initial(runtime, transition.initial, param)
+
+        runtime.transition, runtime.event = outer
+
+        return True
+
+    def enter_initial(self, runtime, state, param):
+        """ Entry through a start or history state without a record """
+        for transition in self.initials[state.state_id]:
+            if self.fire(runtime, transition, None, param):
+                return
+
+    def enter(self, runtime, state, param):
+        kind = self.kinds[state.state_id]
+
+        if kind == START:
+            self.enter_initial(runtime, state, param)
+
+        elif kind == HISTORY:
+            if runtime.has_history_info(state):
+                self.enter(runtime, runtime.get_history_state(state), param)
+            else:
+                self.enter_initial(runtime, state, param)
+
+        elif kind == PSEUDO:
+            runtime.activate(state)
+
+        elif not runtime.is_active(state):
+            runtime.activate(state)
+
+            if runtime.listeners:
+                notify_entered(runtime, state)
+
+                if state.entry:
+                    observe_action(runtime, state, state.entry, param)
+
+                if state.do:
+                    observe_action(runtime, state, state.do, param)
+
+            else:
+                if state.entry:
+                    state.entry.execute(param)
+
+                if state.do:
+                    state.do.execute(param)
+
+            """ Only states with timers or regions have anything left to do """
+            if state.timeouts or kind == CONCURRENT:
+                regions = self.entered(runtime, state, kind)
+            else:
+                regions = ()
+
+            if regions and state.executor:
+                forks = [runtime.fork() for region in regions]
+                results = [state.executor.apply_async(self.enter_region,
+                                (fork, region, param))
+                           for region, fork in zip(regions, forks)]
+
+                for result in results:
+                    result.get()
+
+                runtime.join(forks)
+            else:
+                for region in regions:
+                    self.enter_region(runtime, region, param)
+
+    def enter_region(self, runtime, region, param):
+        self.enter(runtime, region, param)
+        self.enter_initial(runtime, region.start_state, param)
+
+    def exit(self, runtime, state, param):
+        if not runtime.is_active(state):
+            return
+
+        kind = self.kinds[state.state_id]
+        if state.timeouts or kind == HIERARCHICAL or kind == CONCURRENT:
+            for substate in self.exiting(runtime, state, kind):
+                self.exit(runtime, substate, param)
+
+        if state.exit:
+            if runtime.listeners:
+                observe_action(runtime, state, state.exit, param)
+            else:
+                state.exit.execute(param)
+
+        runtime.deactivate(state)
+
+        if runtime.listeners:
+            notify_exited(runtime, state)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+""" Tells a shard worker to exit """
+STOP = object()
+
+class Shard(object):
+
+    """
+        A worker thread with its mailbox and the instances it owns. Only the
+        worker touches the instances, so they need no locking.
+    """
+
+    def __init__(self, dispatcher, index):
+        self.dispatcher = dispatcher
+        self.index = index
+        self.mailbox = Queue()
+        self.instances = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name="statechart-shard-%d" % self.index)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        mailbox = self.mailbox
+        instances = self.instances
+        dispatcher = self.dispatcher
+
+        while True:
+            message = mailbox.get()
+            try:
+                if message is STOP:
+                    return
+
+                key, event = message
+                instance = instances.get(key)
+                if instance == None:
+                    """ Kept once started, a failed start is tried again """
+                    instance = dispatcher.factory(key)
+                    instance.start()
+                    instances[key] = instance
+
+                handled = instance.dispatch(event)
+                if dispatcher.on_result:
+                    dispatcher.on_result(key, event, handled)
+            except Exception as e:
+                dispatcher.failures.append((message, e))
+            finally:
+                mailbox.task_done()
+
+class Dispatcher(object):
+
+    """
+        Owns many statechart instances and routes events to them by key.
+        The keys are spread by hash over a fixed number of shards, each
+        served by its own thread. All the events of a key go through one
+        shard, so they are handled in the order they were dispatched.
+
+        factory(key) returns a new instance, e.g. Statechart.spawn, it is
+        called and started on the first event for the key. on_result, if
+        set, is called by the workers with (key, event, handled). Failed
+        dispatches are kept in failures as ((key, event), exception).
+    """
+
+    def __init__(self, factory, workers=4, on_result=None):
+        self.factory = factory
+        self.on_result = on_result
+        self.failures = []
+        self.shards = [Shard(self, index) for index in range(workers)]
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def dispatch(self, key, event):
+        self.shard(key).mailbox.put((key, event))
+
+    def dispatch_many(self, messages):
+        """ Routes an iterable of (key, event) pairs """
+        shards = self.shards
+        count = len(shards)
+
+        for message in messages:
+            shards[hash(message[0]) % count].mailbox.put(message)
+
+    def join(self):
+        """ Waits until all the events dispatched so far have been handled """
+        for shard in self.shards:
+            shard.mailbox.join()
+
+    def instance(self, key):
+        """ Meant for inspection after join, the workers own the instances """
+        return self.shard(key).instances.get(key)
+
+    def stop(self):
+        for shard in self.shards:
+            shard.mailbox.put(STOP)
+
+        for shard in self.shards:
+            if shard.thread:
+                shard.thread.join()
+                shard.thread = None
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+from collections import deque
+
+""" What to do with an event posted to a full queue """
+RAISE           = 0
+DROP_NEWEST     = 1
+DROP_OLDEST     = 2
+
+class EventQueueFull(Exception):
+    pass
+
+class EventQueue(object):
+
+    """
+        Events posted while a statechart is handling an event. They are
+        dispatched in order once the current event has run to completion.
+        A size of None means that the queue is not bounded.
+    """
+
+    __slots__ = ('events', 'size', 'overflow', 'dropped')
+
+    def __init__(self, size=None, overflow=RAISE):
+        self.events = deque()
+        self.size = size
+        self.overflow = overflow
+        self.dropped = 0
+
+    def put(self, event):
+        """ Returns the event that got dropped to make room, if any """
+        events = self.events
+
+        if self.size == None or len(events) < self.size:
+            events.append(event)
+            return None
+
+        if self.overflow == DROP_NEWEST:
+            self.dropped += 1
+            return event
+
+        if self.overflow == DROP_OLDEST:
+            self.dropped += 1
+            dropped = events.popleft()
+            events.append(event)
+            return dropped
+
+        raise EventQueueFull("Event queue full, size %d" % self.size)
+
+    def get(self):
+        return self.events.popleft()
+
+    def clear(self):
+        self.events.clear()
+
+    def __len__(self):
+        return len(self.events)
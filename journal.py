@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import os
+import struct
+
+from array import array
+from collections import deque
+
+from compiled import CONCURRENT
+from compiled import HIERARCHICAL
+from compiled import HISTORY
+from compiled import PSEUDO
+from compiled import START
+from snapshot import from_bytes
+from snapshot import to_bytes
+from transition import Event
+from timers import After
+
+""" Length of a record, the kind of its event id and the transition count """
+RECORD          = struct.Struct('<IcH')
+INTEGER         = struct.Struct('<q')
+DELAY           = struct.Struct('<d')
+
+NO_EVENT        = b'n'
+INTEGER_EVENT   = b'i'
+STRING_EVENT    = b's'
+
+""" timers.After, its delay followed by the path of its state """
+TIMED_EVENT     = b't'
+
+class JournalError(Exception):
+    pass
+
+def encode_event(event):
+    if event is None:
+        return NO_EVENT, b''
+
+    if isinstance(event, After):
+        if event.path == None:
+            raise JournalError("Cannot journal unbound %r" % (event.id,))
+
+        return TIMED_EVENT, (DELAY.pack(event.delay) +
+                             b''.join([INTEGER.pack(index)
+                                       for index in event.path]))
+
+    id = event.id
+    if isinstance(id, bool) or not isinstance(id, (int, type(2 ** 64), str,
+                                                   type(u''))):
+        raise JournalError("Cannot journal event id %r" % (id,))
+
+    if isinstance(id, (str, type(u''))):
+        return STRING_EVENT, id.encode('utf-8')
+
+    return INTEGER_EVENT, INTEGER.pack(id)
+
+def decode_event(kind, data):
+    if kind == NO_EVENT:
+        return None
+
+    if kind == INTEGER_EVENT:
+        return Event.get(INTEGER.unpack(data)[0])
+
+    if kind == TIMED_EVENT:
+        path = [INTEGER.unpack_from(data, offset)[0] for offset
+                in range(DELAY.size, len(data), INTEGER.size)]
+        return After(DELAY.unpack_from(data)[0], tuple(path))
+
+    id = data.decode('utf-8')
+    if not isinstance(id, str):
+        """ Python 2, ASCII ids were plain strings """
+        try:
+            id = id.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+
+    return Event.get(id)
+
+class Journal(object):
+
+    """
+        Append-only log of the events dispatched to a compiled statechart or
+        one of its instances, each with the ids of the transitions it fired,
+        in firing order, including those out of start and history states.
+        stream is a binary file or buffer opened for appending and reading.
+
+        The journal is replayed on top of a snapshot taken at some offset
+        of it, see mark() and Replay. The timed transitions are recorded
+        once the journal is attached to the target, see attach().
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def attach(self, target):
+        """ 
+            Records the events dispatched by the timers of target from now
+            on. The timers belong to one run, attach again after start() or
+            restore().
+        """
+        timers = target.runtime.timers
+        if timers == None:
+            return
+
+        def dispatch(event):
+            if target.runtime.trace is not None:
+                """ Queued and recorded along with the current event """
+                return target.dispatch(event)
+
+            return self.dispatch(target, event)
+
+        timers.dispatch = dispatch
+
+    def dispatch(self, target, event):
+        """
+            Dispatches the event to target, a started compiled Statechart
+            or StatechartInstance, and records it
+        """
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        runtime = target.runtime
+        assert runtime.trace == None, "Journal dispatch is not reentrant"
+
+        runtime.trace = trace = array('i')
+        try:
+            handled = target.dispatch(event)
+        finally:
+            runtime.trace = None
+
+        self.record(event, trace)
+        return handled
+
+    def record(self, event, transitions):
+        kind, data = encode_event(event)
+        ids = to_bytes(array('i', transitions))
+
+        self.stream.seek(0, os.SEEK_END)
+        self.stream.write(RECORD.pack(RECORD.size + len(data) + len(ids),
+                                      kind, len(transitions)))
+        self.stream.write(data)
+        self.stream.write(ids)
+
+    def mark(self):
+        """ Offset of the next record, to be kept along with a snapshot """
+        self.stream.seek(0, os.SEEK_END)
+        return self.stream.tell()
+
+    def records(self, offset=0):
+        """ Yields the (event, transition ids) pairs following the offset """
+        stream = self.stream
+        stream.seek(offset)
+        itemsize = array('i').itemsize
+
+        while True:
+            header = stream.read(RECORD.size)
+            if not header:
+                return
+
+            if len(header) < RECORD.size:
+                raise JournalError("Journal truncated")
+
+            length, kind, count = RECORD.unpack(header)
+            body = stream.read(length - RECORD.size)
+            if len(body) < length - RECORD.size:
+                raise JournalError("Journal truncated")
+
+            offset += length
+            split = len(body) - count * itemsize
+            event = decode_event(kind, body[:split])
+            yield event, from_bytes('i', body[split:])
+
+            """ The caller may have used the stream in between """
+            stream.seek(offset)
+
+class Replay(object):
+
+    """
+        Rebuilds the configuration of a compiled statechart from a snapshot
+        and the tail of a journal.
+
+        With actions the recorded events are dispatched again, running the
+        guards and actions as the first time. Without, no guard or action is
+        evaluated: the recorded transitions are taken in order and only move
+        the configuration, through the exit and entry lists precomputed for
+        them, keeping the history records up to date. A transition out of a
+        state that is not active means that the journal does not follow on
+        from the snapshot, JournalError is raised.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+
+    def restore(self, snapshot, journal, offset, param=None, actions=False):
+        """ Returns a new runtime in the state the journal left it """
+        runtime = self.compiled.new_runtime()
+        self.compiled.snapshots.read(runtime, snapshot)
+        self.replay(runtime, journal.records(offset), param, actions)
+        return runtime
+
+    def replay(self, runtime, records, param=None, actions=False):
+        compiled = self.compiled
+
+        for event, transitions in records:
+            if actions:
+                compiled.dispatch(runtime, event, param)
+                continue
+
+            pending = deque(transitions)
+            while pending:
+                transition = compiled.transitions[pending.popleft()]
+
+                """ The journal has to follow on from the snapshot """
+                if not self.can_fire(runtime, transition):
+                    raise JournalError("Transition %d out of inactive %r" %
+                                       (transition.id,
+                                        transition.transition.start))
+
+                self.fire(runtime, transition, pending)
+
+    def can_fire(self, runtime, transition):
+        """ 
+            Whether the start of the transition is active. Start and history
+            states are never active, their state must be, as when a state
+            is started on the first event it gets, see CompiledStatechart.
+        """
+        start = transition.transition.start
+        if self.compiled.kinds[start.state_id] in (START, HISTORY):
+            start = start.context
+
+        return runtime.is_active(start)
+
+    def fire(self, runtime, transition, pending):
+        """ As CompiledStatechart.fire, see CompiledStatechart.entered """
+        outer = runtime.transition
+        runtime.transition = transition.transition
+
+        for state in transition.exits:
+            self.exit(runtime, state)
+
+        for state in transition.enters:
+            self.enter(runtime, state, pending)
+
+        if transition.initial:
+            self.enter_initial(runtime, transition.initial, pending)
+
+        runtime.transition = outer
+
+    def enter_initial(self, runtime, state, pending):
+        """
+            Takes the recorded transition out of the state, if one fired.
+            Regions run in parallel record theirs in any order.
+        """
+        initials = self.compiled.initials[state.state_id]
+        for id in pending:
+            transition = self.compiled.transitions[id]
+            if transition in initials:
+                pending.remove(id)
+                self.fire(runtime, transition, pending)
+                return
+
+    def enter(self, runtime, state, pending):
+        kind = self.compiled.kinds[state.state_id]
+
+        if kind == START:
+            self.enter_initial(runtime, state, pending)
+
+        elif kind == HISTORY:
+            if runtime.has_history_info(state):
+                self.enter(runtime, runtime.get_history_state(state), pending)
+            else:
+                self.enter_initial(runtime, state, pending)
+
+        elif kind == PSEUDO:
+            runtime.activate(state)
+
+        elif not runtime.is_active(state):
+            runtime.activate(state)
+
+            if kind == CONCURRENT:
+                for region in state.regions:
+                    if region in runtime.transition.activate:
+                        continue
+
+                    self.enter(runtime, region, pending)
+                    self.enter_initial(runtime, region.start_state, pending)
+
+    def exit(self, runtime, state):
+        if not runtime.is_active(state):
+            return
+
+        kind = self.compiled.kinds[state.state_id]
+
+        if kind == HIERARCHICAL:
+            current_state = runtime.get_current_state(state)
+            if state.history:
+                runtime.store_history_info(state.history, current_state)
+
+            if current_state != None:
+                self.exit(runtime, current_state)
+
+        elif kind == CONCURRENT:
+            for region in state.regions:
+                self.exit(runtime, region)
+
+        runtime.deactivate(state)
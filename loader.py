@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from states import State
+from states import HierarchicalState
+from states import ConcurrentState
+from states import Statechart
+from states import Transition
+from pseudostates import StartState
+from pseudostates import EndState
+from pseudostates import HistoryState
+from transition import Event
+from timers import after
+
+""" 
+    Bumped whenever the format of the cache changes, the attributes of the
+    cached objects are checked by layout()
+"""
+CACHE_VERSION   = 3
+
+""" A statechart with every kind of state, see layout() """
+REFERENCE = {
+    "states": [
+        {"name": "start", "type": "start"},
+        {"name": "A", "states": [
+            {"name": "start_a", "type": "start"},
+            {"name": "history_a", "type": "history"},
+            {"name": "B"}]},
+        {"name": "X", "type": "concurrent", "states": [
+            {"name": "R", "states": [
+                {"name": "start_r", "type": "start"},
+                {"name": "C"}]}]},
+        {"name": "end", "type": "end"}],
+    "transitions": [
+        {"from": "start", "to": "A"},
+        {"from": "start_a", "to": "history_a"},
+        {"from": "history_a", "to": "B"},
+        {"from": "start_r", "to": "C"},
+        {"from": "A", "to": "X", "event": 1},
+        {"from": "X", "to": "end", "event": 2}]}
+
+_layout = None
+
+class LoaderError(Exception):
+    pass
+
+class Loader(object):
+
+    """
+        Builds statecharts from a description made of dicts, lists, strings
+        and numbers, as read from JSON:
+
+            {"states": [{"name": "start", "type": "start"},
+                        {"name": "A", "entry": "log",
+                         "states": [...]},
+                        ...],
+             "transitions": [{"from": "start", "to": "A"},
+                             {"from": "A", "to": "B", "event": 1,
+                              "guard": "ready", "action": "log"},
+                             {"from": "B", "to": "A", "after": 30},
+                             ...]}
+
+        A state type is one of state, hierarchical, concurrent, start,
+        history and end; a state with substates is hierarchical unless it
+        says otherwise, the substates of a concurrent state are its regions.
+        State names are unique over the statechart. Actions and guards are
+        referred to by their name in the actions and guards registries.
+        A transition with "after" is timed, see timers.after.
+
+        load() also compiles the statechart and keeps the compiled form in
+        cache_directory, under the hash of the description, so the next
+        load of the same description does not build it again.
+    """
+
+    def __init__(self, actions=None, guards=None, cache_directory=None):
+        self.actions = actions or {}
+        self.guards = guards or {}
+        self.cache_directory = cache_directory
+
+    def lookup(self, registry, kind, name):
+        if name == None:
+            return None
+
+        if name not in registry:
+            raise LoaderError("Unknown %s %r" % (kind, name))
+
+        return registry[name]
+
+    def build(self, description, param=None):
+        statechart = Statechart(param)
+        states = {}
+
+        for child in description.get('states', ()):
+            self.build_state(statechart, child, states)
+
+        for transition in description.get('transitions', ()):
+            for end in ('from', 'to'):
+                if transition.get(end) not in states:
+                    raise LoaderError("Unknown state %r in transition %r" %
+                                      (transition.get(end), transition))
+
+            event = transition.get('event')
+            if event != None:
+                event = Event(event)
+            elif transition.get('after') != None:
+                event = after(transition['after'])
+
+            Transition(states[transition['from']], states[transition['to']],
+                       event,
+                       self.lookup(self.guards, 'guard',
+                                   transition.get('guard')),
+                       self.lookup(self.actions, 'action',
+                                   transition.get('action')))
+
+        return statechart
+
+    def build_state(self, context, description, states):
+        name = description.get('name')
+        if name == None or name in states:
+            raise LoaderError("Missing or duplicate state name %r" % (name,))
+
+        substates = description.get('states', ())
+        kind = description.get('type')
+        if kind == None:
+            kind = 'hierarchical' if substates else 'state'
+
+        entry = self.lookup(self.actions, 'action', description.get('entry'))
+        do = self.lookup(self.actions, 'action', description.get('do'))
+        exit = self.lookup(self.actions, 'action', description.get('exit'))
+
+        if kind == 'state':
+            state = State(context, entry, do, exit)
+        elif kind == 'hierarchical':
+            state = HierarchicalState(context, entry, do, exit)
+        elif kind == 'concurrent':
+            state = ConcurrentState(context, entry, do, exit)
+        elif kind == 'start':
+            state = StartState(context)
+        elif kind == 'history':
+            state = HistoryState(context)
+        elif kind == 'end':
+            state = EndState(context)
+        else:
+            raise LoaderError("Unknown type %r of state %r" % (kind, name))
+
+        states[name] = state
+
+        for child in substates:
+            if kind == 'concurrent' and child.get('type', 'hierarchical') \
+                    != 'hierarchical':
+                raise LoaderError("Region %r of %r is not hierarchical" %
+                                  (child.get('name'), name))
+
+            self.build_state(state, child, states)
+
+        return state
+
+    def key(self, description):
+        text = json.dumps(description, sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def load(self, description):
+        """ Returns the CompiledStatechart, see CompiledStatechart.spawn """
+        if self.cache_directory == None:
+            return self.build(description).compile()
+
+        path = os.path.join(self.cache_directory,
+                            "%s.chart" % self.key(description))
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as input:
+                    return self.read(input)
+            except Exception:
+                """ 
+                    Stale or damaged, built again. A damaged header may fail
+                    in any way while unpickled.
+                """
+                pass
+
+        compiled = self.build(description).compile()
+
+        descriptor, temporary = tempfile.mkstemp(dir=self.cache_directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as output:
+                self.write(compiled, output)
+            os.rename(temporary, path)
+        except:
+            os.remove(temporary)
+            raise
+
+        return compiled
+
+    def load_json(self, path):
+        with open(path) as input:
+            return self.load(json.load(input))
+
+    def write(self, compiled, output):
+        """
+            Pickles the compiled statechart one object at a time, the other
+            states and transitions being referred to by their index, so that
+            the depth of the pickle does not grow with the statechart. The
+            header holds the SHA-256 of the rest, checked before it is
+            unpickled.
+        """
+        statechart = compiled.statechart
+        assert statechart.runtime == None and statechart.param == None
+
+        """ Numbered in the order read() creates them """
+        items = [compiled] + compiled.states
+        items.extend([t.transition for t in compiled.transitions])
+        items.extend(compiled.transitions)
+
+        objects = dict((id(item), index) for index, item in enumerate(items))
+        for kind, registry in (('action', self.actions),
+                               ('guard', self.guards)):
+            for name, item in registry.items():
+                objects[id(item)] = (kind, name)
+
+        payload = io.BytesIO()
+        pickle.dump(([state.__class__ for state in compiled.states],
+                     len(compiled.transitions)), payload, 2)
+
+        pickler = pickle.Pickler(payload, 2)
+        pickler.persistent_id = lambda item: objects.get(id(item))
+        pickler.dump((attributes(compiled),
+                      [attributes(state) for state in compiled.states],
+                      [attributes(t.transition) for t in compiled.transitions],
+                      [attributes(t) for t in compiled.transitions]))
+
+        payload = payload.getvalue()
+        pickle.dump((CACHE_VERSION, layout(),
+                     hashlib.sha256(payload).hexdigest()), output, 2)
+        output.write(payload)
+
+    def read(self, input):
+        from compiled import CompiledStatechart
+        from compiled import CompiledTransition
+
+        header = pickle.load(input)
+        if header[0] != CACHE_VERSION:
+            raise LoaderError("Cached statechart of version %d" % header[0])
+
+        version, cached_layout, digest = header
+        if cached_layout != layout():
+            raise LoaderError("Cached statechart of another layout")
+
+        payload = input.read()
+        if hashlib.sha256(payload).hexdigest() != digest:
+            raise LoaderError("Cached statechart damaged")
+
+        input = io.BytesIO(payload)
+        classes, count = pickle.load(input)
+
+        compiled = CompiledStatechart.__new__(CompiledStatechart)
+        states = [cls.__new__(cls) for cls in classes]
+        transitions = [Transition.__new__(Transition) for i in range(count)]
+        tables = [CompiledTransition.__new__(CompiledTransition)
+                  for i in range(count)]
+
+        items = [compiled] + states + transitions + tables
+        objects = dict(enumerate(items))
+        for kind, registry in (('action', self.actions),
+                               ('guard', self.guards)):
+            for name, item in registry.items():
+                objects[(kind, name)] = item
+
+        """ A bound dict method, the loader calls it for every reference """
+        unpickler = pickle.Unpickler(input)
+        unpickler.persistent_load = objects.__getitem__
+        try:
+            values = unpickler.load()
+        except KeyError as e:
+            raise LoaderError("Cached statechart refers to unknown %r" %
+                              (e.args[0],))
+
+        for item, value in zip(items, [values[0]] + values[1] + values[2] +
+                                      values[3]):
+            if hasattr(item, '__dict__'):
+                item.__dict__.update(value)
+            else:
+                for name, attribute in value.items():
+                    setattr(item, name, attribute)
+
+        return compiled
+
+def attributes(item):
+    if hasattr(item, '__dict__'):
+        return item.__dict__
+
+    return dict((name, getattr(item, name)) for name in item.__slots__)
+
+def layout():
+    """ 
+        Hash of the classes of the cached objects and of their attribute
+        names, as found in the compiled REFERENCE statechart. A cache
+        written by a version of the code where these differ is built again
+        instead of being loaded with missing attributes.
+    """
+    global _layout
+    if _layout == None:
+        compiled = Loader().build(REFERENCE).compile()
+        items = [compiled] + compiled.states
+        items.extend([t.transition for t in compiled.transitions])
+        items.extend(compiled.transitions)
+
+        names = {}
+        for item in items:
+            cls = item.__class__
+            names.setdefault("%s.%s" % (cls.__module__, cls.__name__),
+                             set()).update(attributes(item))
+
+        text = repr(sorted((cls, sorted(attributes))
+                           for cls, attributes in names.items()))
+        _layout = hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    return _layout
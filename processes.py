@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import multiprocessing
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from transition import Event
+
+""" Messages from the dispatcher to the workers """
+EVENTS          = 0
+JOIN            = 1
+SNAPSHOT        = 2
+KEYS            = 3
+REMOVE          = 4
+RESTORE         = 5
+PARAM           = 6
+STOP            = 7
+
+def serve(connection, model, param):
+    """
+        Body of a worker process. The compiled statechart is loaded once,
+        the instances are spawned from it on the first event of their key.
+    """
+    compiled = model()
+    instances = {}
+    failures = []
+
+    def spawn(key):
+        if param == None:
+            return compiled.spawn(None)
+
+        return compiled.spawn(param(key))
+
+    while True:
+        message = connection.recv()
+        command = message[0]
+
+        if command == EVENTS:
+            for key, event in message[1]:
+                try:
+                    instance = instances.get(key)
+                    if instance == None:
+                        instance = spawn(key)
+                        instance.start()
+                        instances[key] = instance
+
+                    instance.dispatch(event)
+                except Exception as e:
+                    """ The exception itself may not pickle """
+                    failures.append(((key, event), repr(e)))
+
+        elif command == JOIN:
+            connection.send(failures)
+            failures = []
+
+        elif command == SNAPSHOT:
+            instance = instances.get(message[1])
+            connection.send(instance.snapshot() if instance else None)
+
+        elif command == KEYS:
+            connection.send(list(instances))
+
+        elif command == PARAM:
+            instance = instances.get(message[1])
+            try:
+                connection.send(pickle.dumps(instance.param, 2)
+                                if instance else None)
+            except Exception:
+                connection.send(None)
+
+        elif command == REMOVE:
+            """ The param goes along, the instance stays if it cannot """
+            moved = {}
+            kept = []
+            for key in message[1]:
+                instance = instances.get(key)
+                if instance == None:
+                    continue
+
+                try:
+                    param = pickle.dumps(instance.param, 2)
+                except Exception:
+                    kept.append(key)
+                    continue
+
+                moved[key] = (instance.snapshot(), param)
+                del instances[key]
+
+            connection.send((moved, kept))
+
+        elif command == RESTORE:
+            for key, (data, param) in message[1].items():
+                instance = compiled.spawn(pickle.loads(param))
+                instance.restore(data)
+                instances[key] = instance
+
+        elif command == STOP:
+            connection.close()
+            return
+
+class Worker(object):
+
+    """
+        A worker process, the dispatcher end of its pipe and the events
+        waiting to be sent to it
+    """
+
+    def __init__(self, index, model, param):
+        self.index = index
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve,
+                                args=(child, model, param),
+                                name="statechart-worker-%d" % index)
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.pending = []
+
+    def flush(self):
+        if self.pending:
+            self.connection.send((EVENTS, self.pending))
+            self.pending = []
+
+    def call(self, *message):
+        """ Sends message after the pending events and waits for the reply """
+        self.flush()
+        self.connection.send(message)
+        return self.connection.recv()
+
+    def stop(self):
+        self.flush()
+        self.connection.send((STOP,))
+        self.process.join()
+        self.connection.close()
+
+class ProcessDispatcher(object):
+
+    """
+        Dispatcher spreading the instances over worker processes, so that
+        they run on all the cores instead of behind one interpreter lock.
+        The keys are spread by hash, like with dispatcher.Dispatcher, and
+        all the events of a key go through one pipe, in order.
+
+        model() returns the compiled statechart, it is called once in
+        every worker, e.g. a functools.partial of Loader.load, which reads
+        the compiled form from the cache of the loader instead of building
+        the states and transitions again. param(key), if set, returns the
+        parameter of a new instance. Both are sent to the workers, where
+        processes are not forked they have to pickle.
+
+        Events are sent in batches of batch_size (key, event id) pairs;
+        join() sends the incomplete batches and waits for the workers.
+        Failed dispatches are kept in failures as ((key, event id), repr of
+        the exception).
+
+        move() and rebalance() hand instances over to other workers as
+        snapshots, see CompiledStatechart.snapshots, along with their param,
+        pickled. An instance whose param does not pickle stays where it is.
+    """
+
+    def __init__(self, model, workers=4, param=None, batch_size=256):
+        self.model = model
+        self.count = workers
+        self.param = param
+        self.batch_size = batch_size
+        self.failures = []
+        self.workers = []
+
+        """ Keys moved away from the worker given by their hash """
+        self.placement = {}
+
+    def start(self):
+        self.workers = [Worker(index, self.model, self.param)
+                        for index in range(self.count)]
+
+    def worker(self, key):
+        index = self.placement.get(key)
+        if index == None:
+            index = hash(key) % self.count
+
+        return self.workers[index]
+
+    def dispatch(self, key, event):
+        if isinstance(event, Event):
+            event = event.id
+
+        worker = self.worker(key)
+        worker.pending.append((key, event))
+        if len(worker.pending) >= self.batch_size:
+            worker.flush()
+
+    def dispatch_many(self, messages):
+        """ Routes an iterable of (key, event) pairs """
+        for key, event in messages:
+            self.dispatch(key, event)
+
+    def join(self):
+        """ Waits until all the events dispatched so far have been handled """
+        for worker in self.workers:
+            worker.flush()
+
+        for worker in self.workers:
+            self.failures.extend(worker.call(JOIN))
+
+    def snapshot(self, key):
+        """ Snapshot of the instance of key, None if it was never started """
+        return self.worker(key).call(SNAPSHOT, key)
+
+    def instance_param(self, key):
+        """ 
+            A copy of the param of the instance of key, for inspection, None
+            if it was never started or does not pickle
+        """
+        data = self.worker(key).call(PARAM, key)
+        if data == None:
+            return None
+
+        return pickle.loads(data)
+
+    def keys(self):
+        """ The keys of the started instances, per worker """
+        return [worker.call(KEYS) for worker in self.workers]
+
+    def move(self, keys, index):
+        """ 
+            Hands the instances of keys over to worker index, returns how
+            many were moved. The keys without an instance yet go along.
+        """
+        destination = self.workers[index]
+        sources = {}
+        for key in keys:
+            sources.setdefault(self.worker(key), []).append(key)
+
+        moved = 0
+        for source, keys in sources.items():
+            if source is destination:
+                continue
+
+            instances, kept = source.call(REMOVE, keys)
+            destination.connection.send((RESTORE, instances))
+            moved += len(instances)
+
+            kept = set(kept)
+            for key in keys:
+                if key in kept:
+                    continue
+
+                if hash(key) % self.count == index:
+                    self.placement.pop(key, None)
+                else:
+                    self.placement[key] = index
+
+        return moved
+
+    def rebalance(self):
+        """
+            Moves instances off the busiest workers until the numbers of
+            instances differ by one at most, returns how many were moved.
+            The instances that cannot move may leave it uneven.
+        """
+        keys = self.keys()
+        share, extra = divmod(sum(map(len, keys)), self.count)
+
+        """ The busiest workers keep the extra instances """
+        order = sorted(range(self.count), key=lambda index: -len(keys[index]))
+        quotas = {}
+        for rank, index in enumerate(order):
+            quotas[index] = share + (1 if rank < extra else 0)
+
+        surplus = []
+        for index in order:
+            surplus.extend(keys[index][quotas[index]:])
+
+        moved = 0
+        for index in order:
+            wanted = quotas[index] - len(keys[index])
+            if wanted > 0:
+                moved += self.move(surplus[:wanted], index)
+                surplus = surplus[wanted:]
+
+        return moved
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+        self.workers = []
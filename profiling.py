@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import time
+
+from transition import check_guard
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+class Listener(object):
+
+    """
+        Gets told what a statechart does, see Statechart.add_listener. The
+        times are in seconds. With parallel regions the methods are called
+        from the worker threads.
+    """
+
+    def dispatched(self, runtime, event, elapsed):
+        pass
+
+    def fired(self, runtime, transition):
+        pass
+
+    def entered(self, runtime, state):
+        pass
+
+    def exited(self, runtime, state):
+        pass
+
+    def action_executed(self, runtime, owner, action, elapsed):
+        """ owner is the state or the transition the action belongs to """
+        pass
+
+    def guard_checked(self, runtime, transition, result, elapsed):
+        pass
+
+"""
+    Used by the executors once runtime.listeners is known not to be empty,
+    nothing here runs when no listener is registered.
+"""
+
+def observe_dispatch(runtime, event, dispatch, *args):
+    start = clock()
+    result = dispatch(*args)
+    notify_dispatched(runtime, event, clock() - start)
+    return result
+
+def observe_guard(runtime, transition, guard, param):
+    start = clock()
+    result = check_guard(guard, runtime, param)
+    notify_guard(runtime, transition, result, clock() - start)
+    return result
+
+def observe_action(runtime, owner, action, param):
+    start = clock()
+    action.execute(param)
+    notify_action(runtime, owner, action, clock() - start)
+
+def notify_dispatched(runtime, event, elapsed):
+    for listener in runtime.listeners:
+        listener.dispatched(runtime, event, elapsed)
+
+def notify_guard(runtime, transition, result, elapsed):
+    for listener in runtime.listeners:
+        listener.guard_checked(runtime, transition, result, elapsed)
+
+def notify_action(runtime, owner, action, elapsed):
+    for listener in runtime.listeners:
+        listener.action_executed(runtime, owner, action, elapsed)
+
+def notify_fired(runtime, transition):
+    for listener in runtime.listeners:
+        listener.fired(runtime, transition)
+
+def notify_entered(runtime, state):
+    for listener in runtime.listeners:
+        listener.entered(runtime, state)
+
+def notify_exited(runtime, state):
+    for listener in runtime.listeners:
+        listener.exited(runtime, state)
+
+class Histogram(object):
+
+    """ Counts of values in power of two buckets, starting at lowest """
+
+    def __init__(self, lowest=1e-6, buckets=32):
+        self.lowest = lowest
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def bucket(self, value):
+        bound = self.lowest
+        index = 0
+        while value > bound and index < len(self.counts) - 1:
+            bound *= 2
+            index += 1
+
+        return index
+
+    def add(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """ Upper bound of the bucket holding the percentile """
+        wanted = self.count * percent / 100.0
+        seen = 0
+        bound = self.lowest
+
+        for count in self.counts:
+            seen += count
+            if seen >= wanted and seen > 0:
+                return min(bound, self.maximum)
+            bound *= 2
+
+        return self.maximum
+
+class Profiler(Listener):
+
+    """
+        Transition fire counts, time spent in the states, in the actions
+        and guards, and the latency of the dispatches. The dwell time of a
+        state is added when it is exited, the states are told apart per
+        instance by the runtime they were forked from, see RuntimeData.fork.
+    """
+
+    def __init__(self):
+        self.fire_counts = {}
+        self.dwell_times = {}
+        self.action_times = {}
+        self.guard_times = {}
+        self.latency = Histogram()
+        self.entered_at = {}
+
+    def dispatched(self, runtime, event, elapsed):
+        self.latency.add(elapsed)
+
+    def fired(self, runtime, transition):
+        self.fire_counts[transition] = self.fire_counts.get(transition, 0) + 1
+
+    def entered(self, runtime, state):
+        self.entered_at[(id(runtime.owner or runtime), state)] = clock()
+
+    def exited(self, runtime, state):
+        start = self.entered_at.pop((id(runtime.owner or runtime), state),
+                                    None)
+        if start != None:
+            self.add(self.dwell_times, state, clock() - start)
+
+    def action_executed(self, runtime, owner, action, elapsed):
+        self.add(self.action_times, (owner, action), elapsed)
+
+    def guard_checked(self, runtime, transition, result, elapsed):
+        self.add(self.guard_times, transition, elapsed)
+
+    def add(self, totals, key, elapsed):
+        histogram = totals.get(key)
+        if histogram == None:
+            histogram = totals[key] = Histogram()
+
+        histogram.add(elapsed)
+
+    def hot_spots(self, count=10):
+        """ The actions and guards that took the most time, slowest first """
+        spots = [(histogram.total, key) for key, histogram
+                 in list(self.action_times.items()) +
+                    list(self.guard_times.items())]
+        spots.sort(key=lambda spot: spot[0], reverse=True)
+        return spots[:count]
@@ -4,20 +4,86 @@ __author__      = "Vishal Patil"
 __copyright__   = "Copyright 2010 - 2011, Vishal Patil"
 __license__     = "New-style BSD"
 
+from array import array
+
+def net_changes(changes, is_active):
+    """ 
+        Reduces (state, entered) pairs to the states exited and entered:
+        the first change of a state tells whether it was active before
+    """
+    seen = set()
+    exited = []
+    entered = []
+
+    for state, flag in changes:
+        if state in seen:
+            continue
+        seen.add(state)
+
+        if flag and is_active(state):
+            entered.append(state)
+        elif not flag and not is_active(state):
+            exited.append(state)
+
+    return exited, entered
+
+def raw_changes(changes):
+    """ The states exited and entered, each in order, repeats included """
+    exited = [state for state, flag in changes if not flag]
+    entered = [state for state, flag in changes if flag]
+    return exited, entered
+
+def join_forks(runtime, forks):
+    """ Body of RuntimeData.join, shared with CompactRuntimeData """
+    version = runtime.version
+    for fork in forks:
+        version = max(version, fork.version)
+
+    if version != runtime.version:
+        runtime.version = version
+        return
+
+    for fork in forks:
+        runtime.guards.update(fork.guards)
+
 class StateRuntimeData(object):
 
+    __slots__ = ('current_state',)
+
     def __init__(self):
         self.current_state = None
-        self.state_set = list()
 
 class RuntimeData(object):
 
+    __slots__ = ('active_states', 'history_states', 'transition', 'event',
+                 'guards', 'version', 'listeners', 'timers', 'changes',
+                 'owner')
+
+    """ Whether the states skip their consistency checks """
+    trusted = False
+
     def __init__(self):
         self.active_states = {}
         self.history_states = {}
         self.transition = None
         self.event = None
 
+        """ Results of the pure guards, see transition.check_guard """
+        self.guards = {}
+        self.version = 0
+
+        """ The listeners of the statechart, see profiling.Listener """
+        self.listeners = ()
+
+        """ Armed timed transitions, see timers.Timers """
+        self.timers = None
+
+        """ (state, entered) in order once tracked, see take_changes """
+        self.changes = None
+
+        """ The runtime this one was forked from, see fork """
+        self.owner = None
+
     def is_active(self, state):
         status = False
 
@@ -33,13 +99,23 @@ class RuntimeData(object):
         data = self.active_states[state]			
         data.current_state = None
 
+        if self.changes is not None:
+            self.changes.append((state, True))
+
         if state.context:
-            assert self.active_states.has_key(state.context),\
+            assert state.context in self.active_states,\
                 "Activate record not present for parent"
 
             data = self.active_states[state.context]
             data.current_state = state
 
+    def get_current_state(self, state):
+        data = self.active_states.get(state)
+        if data == None:
+            return None
+
+        return data.current_state
+
     def deactivate(self, state):
         if state in self.active_states:
             data = self.active_states[state]
@@ -47,6 +123,65 @@ class RuntimeData(object):
             data = None
             del self.active_states[state]
 
+            if self.changes is not None:
+                self.changes.append((state, False))
+
+    def active_leaves(self):
+        """ The active states without an active substate """
+        active_states = self.active_states
+        for state, data in active_states.items():
+            if (data.current_state == None or 
+                data.current_state not in active_states):
+                yield state
+
+    def take_changes(self, raw=False):
+        """ 
+            Returns the (exited, entered) states since the previous call,
+            states exited and entered again in between are left out unless
+            raw is set, see raw_changes. The first call starts tracking the
+            changes.
+        """
+        if self.changes is None:
+            self.changes = []
+            return [], []
+
+        changes = self.changes
+        self.changes = []
+        if raw:
+            return raw_changes(changes)
+
+        return net_changes(changes, self.is_active)
+
+    def fork(self):
+        """ 
+            Shares the configuration, used to run regions in parallel. The
+            fork checks the pure guards with a copy of the cache, the regions
+            fire transitions independently, see join. owner is the runtime
+            of the statechart, whatever fork it is taken from.
+        """
+        runtime = self.__class__()
+        runtime.active_states = self.active_states
+        runtime.history_states = self.history_states
+        runtime.transition = self.transition
+        runtime.event = self.event
+        runtime.guards = dict(self.guards)
+        runtime.version = self.version
+        runtime.listeners = self.listeners
+        runtime.timers = self.timers
+        runtime.changes = self.changes
+        runtime.owner = self.owner or self
+        return runtime
+
+    def join(self, forks):
+        """ 
+            Takes back what forks learnt about the param: the newest version
+            if a region fired a transition, else their guard results
+        """
+        join_forks(self, forks)
+
+    def param_changed(self):
+        self.version += 1
+
     def has_history_info(self, history_state):
         status = False
 
@@ -65,5 +200,214 @@ class RuntimeData(object):
         self.history_states[history_state] = actual_state
 
     def reset(self):
+        if self.timers:
+            self.timers.clear()
+
         self.active_states.clear()
         self.history_states.clear()
+        self.guards.clear()
+
+class TrustedRuntimeData(RuntimeData):
+
+    """ 
+        Runtime data of a statechart validated by Statechart.trust, without
+        the checks made on every activation
+    """
+
+    __slots__ = ()
+
+    trusted = True
+
+    def activate(self, state):
+        active_states = self.active_states
+
+        data = active_states.get(state)
+        if data == None:
+            data = active_states[state] = StateRuntimeData()
+        data.current_state = None
+
+        if self.changes is not None:
+            self.changes.append((state, True))
+
+        if state.context:
+            active_states[state.context].current_state = state
+
+    def get_history_state(self, history_state):
+        return self.history_states[history_state]
+
+class CompactRuntimeData(object):
+
+    """
+        Runtime data of a compiled statechart. The configuration is kept in
+        fixed size arrays indexed by the ids of the CompiledStatechart, so
+        activating and deactivating states does not allocate. The state
+        arguments and results are State objects, as with RuntimeData.
+    """
+
+    __slots__ = ('compiled', 'active', 'current', 'history', 'leaves',
+                 'transition', 'event', 'trace', 'guards', 'version',
+                 'listeners', 'timers', 'changes', 'owner')
+
+    def __init__(self, compiled):
+        count = len(compiled.states)
+        typecode = 'h' if count < 0x8000 else 'i'
+
+        self.compiled = compiled
+        self.active = bytearray(count)
+        self.current = array(typecode, [-1]) * count
+
+        """ Stored state per history state, see CompiledStatechart.histories """
+        self.history = array(typecode, [-1]) * len(compiled.history_states)
+
+        """ Deepest active state per segment, see CompiledStatechart """
+        self.leaves = array(typecode, [-1]) * compiled.segment_count
+
+        self.transition = None
+        self.event = None
+
+        """ When set, the ids of the transitions fired are appended to it """
+        self.trace = None
+
+        self.guards = {}
+        self.version = 0
+
+        """ The listeners of the statechart, see profiling.Listener """
+        self.listeners = ()
+
+        """ Armed timed transitions, see timers.Timers """
+        self.timers = None
+
+        """ (state, entered) in order once tracked, see take_changes """
+        self.changes = None
+
+        """ The runtime this one was forked from, see RuntimeData.fork """
+        self.owner = None
+
+    def is_active(self, state):
+        return self.active[state.state_id] == 1
+
+    def activate(self, state):
+        id = state.state_id
+        compiled = self.compiled
+
+        self.active[id] = 1
+        self.current[id] = -1
+
+        parent = compiled.parents[id]
+        if parent != -1:
+            self.current[parent] = id
+
+        self.leaves[compiled.segments[id]] = id
+
+        if self.changes is not None:
+            self.changes.append(id)
+
+    def deactivate(self, state):
+        id = state.state_id
+        compiled = self.compiled
+
+        self.active[id] = 0
+        self.current[id] = -1
+
+        """ The leaf of the segment moves up, out of the region at its root """
+        segment = compiled.segments[id]
+        if self.leaves[segment] == id:
+            parent = compiled.parents[id]
+            if parent != -1 and compiled.segments[parent] == segment:
+                self.leaves[segment] = parent
+            else:
+                self.leaves[segment] = -1
+
+        if self.changes is not None:
+            self.changes.append(~id)
+
+    def active_leaves(self):
+        """ The active states without an active substate, one per segment """
+        states = self.compiled.states
+        active = self.active
+        current = self.current
+
+        for id in self.leaves:
+            if id != -1 and (current[id] == -1 or not active[current[id]]):
+                yield states[id]
+
+    def take_changes(self, raw=False):
+        """ See RuntimeData.take_changes """
+        if self.changes is None:
+            self.changes = []
+            return [], []
+
+        states = self.compiled.states
+        changes = [(states[id], True) if id >= 0 else (states[~id], False)
+                   for id in self.changes]
+        self.changes = []
+        if raw:
+            return raw_changes(changes)
+
+        return net_changes(changes, self.is_active)
+
+    def fork(self):
+        """ Shares the configuration, used to run regions in parallel """
+        runtime = CompactRuntimeData.__new__(CompactRuntimeData)
+        runtime.compiled = self.compiled
+        runtime.active = self.active
+        runtime.current = self.current
+        runtime.history = self.history
+        runtime.leaves = self.leaves
+        runtime.transition = self.transition
+        runtime.event = self.event
+        runtime.trace = self.trace
+        runtime.guards = dict(self.guards)
+        runtime.version = self.version
+        runtime.listeners = self.listeners
+        runtime.timers = self.timers
+        runtime.changes = self.changes
+        runtime.owner = self.owner or self
+        return runtime
+
+    def join(self, forks):
+        """ See RuntimeData.join """
+        join_forks(self, forks)
+
+    def param_changed(self):
+        self.version += 1
+
+    def get_current_state(self, state):
+        id = self.current[state.state_id]
+        if id == -1:
+            return None
+
+        return self.compiled.states[id]
+
+    def has_history_info(self, history_state):
+        index = self.compiled.histories[history_state.state_id]
+        return self.history[index] != -1
+
+    def get_history_state(self, history_state):
+        assert self.has_history_info(history_state),\
+            "Record not found for history state"
+
+        index = self.compiled.histories[history_state.state_id]
+        return self.compiled.states[self.history[index]]
+
+    def store_history_info(self, history_state, actual_state):
+        index = self.compiled.histories[history_state.state_id]
+        if actual_state == None:
+            self.history[index] = -1
+        else:
+            self.history[index] = actual_state.state_id
+
+    def reset(self):
+        typecode = self.current.typecode
+
+        if self.timers:
+            self.timers.clear()
+
+        """ In place, the executor may hold on to the arrays """
+        self.active[:] = bytearray(len(self.active))
+        self.current[:] = array(typecode, [-1]) * len(self.current)
+        self.history[:] = array(typecode, [-1]) * len(self.history)
+        self.leaves[:] = array(typecode, [-1]) * len(self.leaves)
+        self.transition = None
+        self.event = None
+        self.guards.clear()
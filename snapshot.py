@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import struct
+import sys
+import zlib
+
+from array import array
+
+MAGIC           = b'SC'
+VERSION         = 1
+
+""" Magic, format version, flags and the fingerprint of the statechart """
+HEADER          = struct.Struct('<2sBBI')
+
+""" 
+    Whether arrays can be viewed as bytes, so that the vectors go straight
+    to and from the buffer. Python 2 copies them through strings.
+"""
+VIEWS           = hasattr(memoryview, 'cast')
+
+class SnapshotError(Exception):
+    pass
+
+def to_bytes(data):
+    if hasattr(data, 'tobytes'):
+        return data.tobytes()
+
+    return data.tostring()
+
+def from_bytes(typecode, data):
+    result = array(typecode)
+    if hasattr(result, 'frombytes'):
+        result.frombytes(data)
+    else:
+        result.fromstring(data)
+
+    return result
+
+def fingerprint(compiled):
+    """ Checksum of the structure of a compiled statechart """
+    description = [repr(compiled.kinds), repr(compiled.parents)]
+    for transition in compiled.transitions:
+        t = transition.transition
+        event = None
+        if t.event is not None:
+            event = t.event.id
+
+        description.append(repr((t.start.state_id, t.end.state_id, event,
+                                 t.guard is not None)))
+
+    return zlib.crc32('\n'.join(description).encode('utf-8')) & 0xffffffff
+
+class SnapshotFormat(object):
+
+    """
+        Fixed size binary image of a CompactRuntimeData: a header followed
+        by the active flags and the current state, history and leaf
+        vectors, copied as they are. The fingerprint ties the image to the
+        statechart it was taken from; the integers are in the byte order of
+        the machine, which is recorded in the flags.
+
+        The vectors are copied between the runtime and the buffer through
+        memoryviews, without intermediate bytes, see VIEWS.
+    """
+
+    def __init__(self, compiled):
+        runtime = compiled.new_runtime()
+
+        self.compiled = compiled
+        self.fingerprint = fingerprint(compiled)
+        self.typecode = runtime.current.typecode
+
+        itemsize = runtime.current.itemsize
+        self.flags = itemsize << 1
+        if sys.byteorder == 'big':
+            self.flags |= 1
+
+        self.sizes = (len(runtime.active),
+                      len(runtime.current) * itemsize,
+                      len(runtime.history) * itemsize,
+                      len(runtime.leaves) * itemsize)
+        self.size = HEADER.size + sum(self.sizes)
+
+    def write(self, runtime, buffer, offset=0):
+        """ Writes the snapshot into a bytearray, mmap or similar buffer """
+        HEADER.pack_into(buffer, offset, MAGIC, VERSION, self.flags,
+                         self.fingerprint)
+
+        start = offset + HEADER.size
+        vectors = (runtime.active, runtime.current, runtime.history,
+                   runtime.leaves)
+
+        if VIEWS:
+            for vector, size in zip(vectors, self.sizes):
+                buffer[start:start + size] = memoryview(vector).cast('B')
+                start += size
+
+            return start
+
+        for data in (bytes(vectors[0]), to_bytes(vectors[1]),
+                     to_bytes(vectors[2]), to_bytes(vectors[3])):
+            buffer[start:start + len(data)] = data
+            start += len(data)
+
+        return start
+
+    def snapshot(self, runtime):
+        buffer = bytearray(self.size)
+        self.write(runtime, buffer)
+        return bytes(buffer)
+
+    def check(self, buffer, offset=0):
+        if len(buffer) - offset < self.size:
+            raise SnapshotError("Snapshot truncated")
+
+        magic, version, flags, fingerprint = HEADER.unpack_from(buffer, offset)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError("Not a statechart snapshot")
+
+        if flags != self.flags:
+            raise SnapshotError("Snapshot taken on another platform")
+
+        if fingerprint != self.fingerprint:
+            raise SnapshotError("Snapshot of another statechart")
+
+    def read(self, runtime, buffer, offset=0):
+        """
+            Restores the runtime from a snapshot in place, no actions are
+            run. Returns the offset following the snapshot.
+        """
+        self.check(buffer, offset)
+
+        start = offset + HEADER.size
+        vectors = (runtime.active, runtime.current, runtime.history,
+                   runtime.leaves)
+
+        if VIEWS:
+            source = memoryview(buffer)
+            try:
+                for vector, size in zip(vectors, self.sizes):
+                    memoryview(vector).cast('B')[:] = \
+                        source[start:start + size]
+                    start += size
+            finally:
+                """ An mmap cannot be closed while it is viewed """
+                source.release()
+        else:
+            active = self.sizes[0]
+            runtime.active[:] = bytearray(buffer[start:start + active])
+            start += active
+
+            for vector, size in zip(vectors[1:], self.sizes[1:]):
+                data = bytes(buffer[start:start + size])
+                vector[:] = from_bytes(self.typecode, data)
+                start += size
+
+        runtime.transition = None
+        runtime.event = None
+        return start
+
+    def write_many(self, runtimes, buffer, offset=0):
+        """ Writes the snapshots back to back, record i is at i * size """
+        for runtime in runtimes:
+            offset = self.write(runtime, buffer, offset)
+
+        return offset
@@ -4,7 +4,22 @@ __author__      = "Vishal Patil"
 __copyright__   = "Copyright 2010 - 2011, Vishal Patil"
 __license__     = "New-style BSD"
 
+import warnings
+
 from runtime import RuntimeData
+from runtime import TrustedRuntimeData
+from eventqueue import EventQueue
+from eventqueue import RAISE
+from transition import Event
+from transition import check_guard
+from profiling import notify_entered
+from profiling import notify_exited
+from profiling import notify_fired
+from profiling import observe_action
+from profiling import observe_dispatch
+from profiling import observe_guard
+from timers import After
+from timers import Timers
 
 class State(object):
 
@@ -15,49 +30,113 @@ class State(object):
             assert False, "context cannot be null"	
 
         self.context = context
-        parent = context	
 
-        """ Recursively move up to get the statechart object """
-        if parent != None:
-            while 1:
-                if isinstance(parent, Statechart):
-                    break
+        """ 
+            The statechart and the depth are taken from the context, which
+            is built first, the statechart being its own statechart at 0
+        """
+        if context == None:
+            self.statechart = self
+            self.depth = 0
+        else:
+            self.statechart = context.statechart
+            self.depth = context.depth + 1
 
-                if parent == None:
-                    break
-
-                parent = parent.context
-            
-            if isinstance(parent, Statechart):
-                self.statechart = parent 
-            else:
-                assert False, "Statechart not found check hierarchy"
+            context.substates.append(self)
 
         self.entry = entry 
         self.do    = do 
         self.exit  = exit 
         self.transitions = []
 
+        """ Event id to candidate transitions, built on the first dispatch """
+        self.dispatch_index = None
+        self.eventless_transitions = []
+
+        """ Events of the timed transitions, armed while the state is active """
+        self.timeouts = ()
+
     def add_transition(self, transition):
         if transition == None:
             assert False, "Cannot add null transition"
 
+        assert self.statechart.compiled == None,\
+            "Cannot add transition to a compiled statechart"
+        assert not self.statechart.trusted,\
+            "Cannot add transition to a trusted statechart"
+
         if (transition.guard):
             self.transitions.insert(0, transition)
         else:
             self.transitions.append(transition)
 
+        if isinstance(transition.event, After):
+            transition.event = transition.event.bind(self)
+            if transition.event not in self.timeouts:
+                self.timeouts += (transition.event,)
+
+        self.dispatch_index = None
+
+    def build_dispatch_index(self):
+        self.dispatch_index, self.eventless_transitions = \
+            self.dispatch_tables()
+
+    def dispatch_tables(self):
+        """ The (event id to candidates, eventless candidates) of the state """
+        index = {}
+        eventless = []
+
+        """ 
+            Every bucket is a subsequence of self.transitions, so the guarded
+            transitions are still tried first. Eventless transitions match
+            any event and hence are merged into all the buckets.
+        """
+        for transition in self.transitions:
+            if transition.event is None:
+                eventless.append(transition)
+                for candidates in index.values():
+                    candidates.append(transition)
+            else:
+                candidates = index.get(transition.event.id)
+                if candidates is None:
+                    candidates = index[transition.event.id] = list(eventless)
+                candidates.append(transition)
+
+        return index, eventless
+
+    def get_transitions(self, event):
+        if self.dispatch_index is None:
+            self.build_dispatch_index()
+
+        if event is None:
+            return self.eventless_transitions
+
+        return self.dispatch_index.get(event.id, self.eventless_transitions)
+
     def activate(self, runtime, param):
         activated = False
 
         if not runtime.is_active(self):
             runtime.activate(self)
 
-            if self.entry:
-                self.entry.execute(param)
+            if runtime.listeners:
+                notify_entered(runtime, self)
+
+                if self.entry:
+                    observe_action(runtime, self, self.entry, param)
+
+                if self.do:
+                    observe_action(runtime, self, self.do, param)
+
+            else:
+                if self.entry:
+                    self.entry.execute(param)
             
-            if self.do:
-                self.do.execute(param)
+                if self.do:
+                    self.do.execute(param)
+
+            if self.timeouts and runtime.timers:
+                runtime.timers.arm(self)
 
             activated = True
             
@@ -67,16 +146,25 @@ class State(object):
     def deactivate(self, runtime, param):
         if runtime.is_active(self):
 
+            if self.timeouts and runtime.timers:
+                runtime.timers.cancel(self)
+
             if self.exit:
-                self.exit.execute(param)
+                if runtime.listeners:
+                    observe_action(runtime, self, self.exit, param)
+                else:
+                    self.exit.execute(param)
 
             runtime.deactivate(self)
 
+            if runtime.listeners:
+                notify_exited(runtime, self)
+
     def dispatch(self, runtime, event, param):
         status = False
 
-        for transition in self.transitions:	
-            if transition.execute(runtime, event, param):
+        for transition in self.get_transitions(event):
+            if transition.fire(runtime, event, param):
                 status = True
                 break
 
@@ -85,8 +173,28 @@ class State(object):
 class Context(State):
 
     def __init__(self, parent, entry, do, exit):
+        self.substates = []
         State.__init__(self, parent, entry, do, exit)
         self.start_state = None 
+        self.factory = None
+
+    def set_factory(self, factory):
+        """ 
+            Defers building the substates: factory(self) creates them and
+            their transitions the first time the state is entered, once for
+            all the runs of the statechart. Compiling builds them all.
+        """
+        assert not self.substates, "Substates already built"
+        assert self.statechart.compiled == None,\
+            "Cannot defer substates of a compiled statechart"
+
+        self.factory = factory
+
+    def materialize(self):
+        if self.factory != None:
+            factory = self.factory
+            self.factory = None
+            factory(self)
 
 class Transition(object):
 
@@ -108,51 +216,40 @@ class Transition(object):
         start.add_transition(self)
 
     def calculate_changed_states(self, start, end):
-        start_states = list()
-        end_states = list()
-
-        """ Recursively get all the context start states """
+        """ 
+            Move up from the deeper state until both are at the same depth,
+            then from both until they meet at the Least Common Ancestor (LCA)
+        """
         s = start
-        while s != None:
-            start_states.insert(0, s)
-            context = s.context
-            if context and not isinstance(context, Statechart):
-                s = context
-            else:
-                s = None
-
-        """ Recursively get all the context end states """
         e = end
-        while e != None:
-            end_states.insert(0, e)
-            context = e.context
-            if context and not isinstance(context, Statechart):
-                e = context
-            else:
-                e = None
-
-        """ Get the Least Common Ancestor (LCA) of the start and end states """
-        min_state_count = min(len(start_states), len(end_states))
-        lca = min_state_count - 1
-
-        if (start != end):
-            lca = 0
-            while lca < min_state_count:
-                if (start_states[lca] != end_states[lca]):
-                    break
-                lca += 1
-
-        """ Starting from the LCA get the states that will be deactivated """
-        i = lca 
-        while  i < len(start_states):
-            self.deactivate.insert(0, start_states[i])
-            i += 1
-
-        """ Starting from the LCA get the states that will be activated """
-        i = lca 
-        while  i < len(end_states):
-            self.activate.append(end_states[i])
-            i += 1
+        entered = []
+
+        while s.depth > e.depth:
+            self.deactivate.append(s)
+            s = s.context
+
+        while e.depth > s.depth:
+            entered.append(e)
+            e = e.context
+
+        while s != e:
+            self.deactivate.append(s)
+            entered.append(e)
+            s = s.context
+            e = e.context
+
+        """ 
+            A transition to itself, an ancestor or a descendant, or from one
+            region to another, also exits and enters again the state where
+            the paths meet, the active substates of which are exited with it
+        """
+        if s == start or s == end or isinstance(s, ConcurrentState):
+            self.deactivate.append(s)
+            entered.append(e)
+
+        """ Innermost state first on the way out, outermost on the way in """
+        entered.reverse()
+        self.activate.extend(entered)
 
     def execute(self, runtime, event, param):
         if (self.event and (event == None)):
@@ -161,9 +258,27 @@ class Transition(object):
         if (self.event and (self.event != event)):
             return False
 
-        if (self.guard and (not self.guard.check(runtime, param))):
-            return False
+        return self.fire(runtime, event, param)
+
+    def fire(self, runtime, event, param):
+        """ Event matching is left to the caller, see State.get_transitions """
+        listeners = runtime.listeners
 
+        if self.guard:
+            if listeners:
+                if not observe_guard(runtime, self, self.guard, param):
+                    return False
+            elif not check_guard(self.guard, runtime, param):
+                return False
+
+        """ The actions may change the param """
+        runtime.version += 1
+
+        if listeners:
+            notify_fired(runtime, self)
+
+        """ Entering a start state fires transitions within this one """
+        outer = (runtime.transition, runtime.event)
         runtime.event = event
         runtime.transition = self 
 
@@ -171,13 +286,15 @@ class Transition(object):
             state.deactivate(runtime, param)
 
         if self.action:
-            self.action.execute(param)	
+            if listeners:
+                observe_action(runtime, self, self.action, param)
+            else:
+                self.action.execute(param)	
 
         for state in self.activate:
             state.activate(runtime, param)
 
-        runtime.transition = None 
-        runtime.event = None
+        runtime.transition, runtime.event = outer
 
         return True	
 
@@ -192,6 +309,9 @@ class HierarchicalState(Context):
            parent.add_region(self) 
 
     def activate(self, runtime, param):
+        if self.factory != None:
+            self.materialize()
+
         Context.activate(self, runtime, param)
 
         if (runtime.transition and 
@@ -200,7 +320,8 @@ class HierarchicalState(Context):
 
     def deactivate(self, runtime, param):
 
-        assert (self in runtime.active_states), self
+        if not runtime.trusted:
+            assert (self in runtime.active_states), self
                         
         rdata = runtime.active_states[self]
         if self.history:
@@ -213,7 +334,7 @@ class HierarchicalState(Context):
 
     def dispatch(self, runtime, event, param):
         
-        if not runtime.active_states[self]:
+        if not runtime.trusted and not runtime.active_states[self]:
             assert False, (("HierarchicalState: " +
                         "trying to dispatch on inactive state"))
 
@@ -231,8 +352,8 @@ class HierarchicalState(Context):
             Since none of the child states can handle the event, let this 
             state try handling the event.
         """
-        for transition in self.transitions: 
-            if transition.execute(runtime, event, param):
+        for transition in self.get_transitions(event): 
+            if transition.fire(runtime, event, param):
                 return True
 
         return False                
@@ -242,23 +363,96 @@ class ConcurrentState(Context):
     def __init__(self, context, entry, do, exit):
         Context.__init__(self, context, entry, do, exit)
         self.regions = []
+        self.parallel = False
+        self.executor = None
 
     def add_region(self, region):
         self.regions.append(region)
 
+    def set_parallel(self, executor=None):
+        """ 
+            Lets the regions handle the events and get entered in parallel,
+            on the executor (anything with the apply_async method of
+            multiprocessing.pool.ThreadPool) or as tasks of AsyncStatechart.
+            The results are merged in region order. Call this once all the
+            regions have been built, it warns about state the regions share.
+        """
+        self.parallel = True
+        self.executor = executor
+
+        for warning in self.check_regions():
+            warnings.warn(warning, RuntimeWarning)
+
+    def check_regions(self):
+        """ Actions and guards used by more than one region, transitions 
+            leaving their region """
+        owners = {}
+        problems = []
+
+        for region in self.regions:
+            states = [region]
+            inside = set()
+            while states:
+                state = states.pop()
+                inside.add(state)
+                states.extend(getattr(state, 'substates', ()))
+
+            for state in inside:
+                shared = [state.entry, state.do, state.exit]
+                for transition in state.transitions:
+                    shared.append(transition.guard)
+                    shared.append(transition.action)
+
+                    if transition.end not in inside:
+                        problems.append(("Transition from %s leaves region "
+                            "%s while regions run in parallel") %
+                            (state, region))
+
+                for item in shared:
+                    if item == None:
+                        continue
+
+                    owner = owners.setdefault(id(item), region)
+                    if owner is not region:
+                        problems.append(("%s is shared by regions %s and "
+                            "%s") % (item, owner, region))
+
+        return problems
+
     def activate(self, runtime, param):
         status = False
 
-        if Context.activate(self, runtime, param):
-            rdata = runtime.active_states[self]
+        if self.factory != None:
+            self.materialize()
 
-            for region in self.regions:
-                if not (region in rdata.state_set):
-                    region.activate(runtime, param)
-                    region.start_state.activate(runtime, param)
+        if Context.activate(self, runtime, param):
+            """ The region a transition enters explicitly is left to it """
+            regions = self.regions
+            if runtime.transition:
+                regions = [region for region in regions
+                           if region not in runtime.transition.activate]
+
+            if self.executor:
+                forks = [runtime.fork() for region in regions]
+                results = [self.executor.apply_async(self.enter_region,
+                                (region, fork, param))
+                           for region, fork in zip(regions, forks)]
+
+                for result in results:
+                    result.get()
+
+                runtime.join(forks)
+                return status
+
+            for region in regions:
+                self.enter_region(region, runtime, param)
                     
         return status            
 
+    def enter_region(self, region, runtime, param):
+        region.activate(runtime, param)
+        region.start_state.activate(runtime, param)
+
     def deactivate(self, runtime, param):
         for region in self.regions:
             if runtime.is_active(region):
@@ -268,22 +462,36 @@ class ConcurrentState(Context):
 
     def dispatch(self, runtime, event, param):
 
-        if not runtime.active_states[self]:
+        if not runtime.trusted and not runtime.active_states[self]:
             assert False, "Dispatching an event on inactive state"
 
         dispatched = False
 
         """ Check if any of the child regions can handle the event """
-        for region in self.regions:
-            if region.dispatch(runtime, event, param):
-                dispatched = True
+        if self.executor:
+            forks = [runtime.fork() for region in self.regions]
+            results = [self.executor.apply_async(region.dispatch, 
+                                    (fork, event, param))
+                       for region, fork in zip(self.regions, forks)]
+
+            for result in results:
+                if result.get():
+                    dispatched = True
+
+            runtime.join(forks)
+        else:
+            """ A transition leaving its region may have exited the others """
+            for region in self.regions:
+                if (runtime.is_active(region) and
+                    region.dispatch(runtime, event, param)):
+                    dispatched = True
 
         if dispatched:
             return True
 
         """ Check if this state can handle the event by itself """
-        for transition in self.transitions:
-            if transition.execute(runtime, event, param):
+        for transition in self.get_transitions(event):
+            if transition.fire(runtime, event, param):
                dispatched = True
                break
 
@@ -291,20 +499,245 @@ class ConcurrentState(Context):
 
 class Statechart(Context):
 
-    def __init__(self, param):
+    def __init__(self, param, queue_size=None, overflow=RAISE):
+        """ 
+            queue_size and overflow bound the queue of the events posted
+            while an event is handled, see eventqueue.EventQueue
+        """
         Context.__init__(self, None, None, None, None) 
         self.param = param
+        self.runtime = None
+        self.compiled = None
+        self.queue = EventQueue(queue_size, overflow)
+        self.dispatching = False
+        self.timing_wheel = None
+        self.trusted = False
+
+        """ See profiling.Listener, shared by all the runs of the chart """
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def set_timing_wheel(self, wheel):
+        """ 
+            Runs the timed transitions, see timers.after, on the wheel. The
+            runs of the statechart started from now on use it.
+        """
+        self.timing_wheel = wheel
+
+    def trust(self):
+        """ 
+            Validates the statechart once, see analysis.Analysis, then runs
+            it without the consistency checks the states make on every
+            event. Transitions cannot be added afterwards and the deferred
+            substates are built now.
+        """
+        from analysis import Analysis
+        from analysis import ValidationError
+
+        assert self.runtime == None,\
+            "Statechart has to be trusted before it is started"
+
+        pending = [self]
+        while pending:
+            state = pending.pop()
+            if getattr(state, 'factory', None) != None:
+                state.materialize()
+            pending.extend(getattr(state, 'substates', ()))
+
+        errors = Analysis(self).errors()
+        if errors:
+            raise ValidationError("; ".join(errors))
+
+        self.trusted = True
+
+    def compile(self):
+        """ 
+            Freezes the states and transitions of the statechart, dispatch
+            is then run by the table driven CompiledStatechart.
+        """
+        from compiled import CompiledStatechart
+
+        assert self.runtime == None,\
+            "Statechart has to be compiled before it is started"
+
+        self.compiled = CompiledStatechart(self)
+        return self.compiled
+
+    def spawn(self, param, queue_size=None, overflow=RAISE):
+        """ 
+            Returns a new instance of the statechart with its own parameter
+            and event queue, the statechart gets compiled on the first call.
+        """
+        if not self.compiled:
+            self.compile()
+
+        return self.compiled.spawn(param, queue_size, overflow)
 
     def start(self):
-        self.runtime = RuntimeData()
+        if self.runtime and self.runtime.timers:
+            self.runtime.timers.clear()
+
+        if self.compiled:
+            self.runtime = self.compiled.new_runtime()
+        elif self.trusted:
+            self.runtime = TrustedRuntimeData()
+            self.runtime.listeners = self.listeners
+        else:
+            self.runtime = RuntimeData()
+            self.runtime.listeners = self.listeners
+
+        if self.timing_wheel != None:
+            self.runtime.timers = Timers(self.timing_wheel, self.dispatch)
+
+        self.queue.clear()
         self.runtime.reset()
         self.runtime.activate(self)
         self.runtime.activate(self.start_state)
         self.dispatch(None)
 
+    def post(self, event):
+        """ Queues an event, it is dispatched once the current one is done """
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        self.queue.put(event)
+
     def dispatch(self, event):
-        current_state = self.runtime.active_states[self].current_state
-        return current_state.dispatch(self.runtime, event, self.param)	
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        if self.dispatching:
+            """ Dispatch from an action, run it after the current event """
+            self.queue.put(event)
+            return False
+
+        self.dispatching = True
+        try:
+            status = self.dispatch_event(event)
+
+            queue = self.queue
+            while queue:
+                self.dispatch_event(queue.get())
+        finally:
+            self.dispatching = False
+
+        return status
+
+    def dispatch_event(self, event):
+        if self.compiled:
+            return self.compiled.dispatch(self.runtime, event, self.param) != -1
+
+        runtime = self.runtime
+        current_state = runtime.active_states[self].current_state
+        if runtime.listeners:
+            return observe_dispatch(runtime, event, current_state.dispatch,
+                                    runtime, event, self.param)
+
+        return current_state.dispatch(runtime, event, self.param)	
+
+    def dispatch_many(self, events):
+        """ 
+            Dispatches a sequence of events, returns an array with the id of
+            the transition fired for each of them or -1. The ids index
+            CompiledStatechart.transitions, so the statechart has to be
+            compiled, see compile().
+        """
+        if not self.compiled:
+            raise RuntimeError("Batch dispatch needs a compiled statechart")
+
+        if self.dispatching:
+            raise RuntimeError("Batch dispatch from an action")
+
+        self.dispatching = True
+        try:
+            return self.compiled.dispatch_many(self.runtime, events,
+                                               self.param, self.queue)
+        finally:
+            self.dispatching = False
+
+    def dispatch_stream(self, events):
+        """ 
+            Generator version of dispatch_many for unbounded event streams,
+            raises right away if the statechart is not compiled or if it is
+            called from an action
+        """
+        if not self.compiled:
+            raise RuntimeError("Batch dispatch needs a compiled statechart")
+
+        if self.dispatching:
+            raise RuntimeError("Batch dispatch from an action")
+
+        return self.stream(self.compiled.dispatch_stream(self.runtime, events,
+                                                         self.param,
+                                                         self.queue))
+
+    def stream(self, stream):
+        """ Events are dispatched as the stream is consumed, not by actions """
+        while True:
+            dispatching = self.dispatching
+            if dispatching:
+                raise RuntimeError("Batch dispatch from an action")
+
+            self.dispatching = True
+            try:
+                id = next(stream)
+            except StopIteration:
+                return
+            finally:
+                self.dispatching = dispatching
+
+            yield id
+
+    def param_changed(self):
+        """ 
+            To call when the param is changed from outside of the actions,
+            the results of the pure guards are dropped.
+        """
+        self.runtime.param_changed()
+
+    def is_in(self, state):
+        """ Whether state is in the active configuration """
+        return self.runtime.is_active(state)
+
+    def active_leaves(self):
+        """ The innermost active states, an iterator over the runtime """
+        return self.runtime.active_leaves()
+
+    def changes(self, raw=False):
+        """ 
+            The (exited, entered) states since the previous call, to call
+            after every dispatch. Tracking starts with the first call.
+
+            The changes are netted: a state exited and entered again, by a
+            self transition or the exit of an ancestor, is in neither list.
+            With raw set, both lists hold every exit and entry, in the order
+            they happened.
+        """
+        return self.runtime.take_changes(raw)
+
+    def snapshot(self):
+        """ Binary image of the configuration, see snapshot.SnapshotFormat """
+        assert self.compiled, "Snapshots need a compiled statechart"
+        return self.compiled.snapshots.snapshot(self.runtime)
+
+    def restore(self, data):
+        """ 
+            Resumes from a snapshot, without running any entry action. The
+            timed transitions of the active states start over.
+        """
+        assert self.compiled, "Snapshots need a compiled statechart"
+
+        if self.runtime == None:
+            self.runtime = self.compiled.new_runtime(self.dispatch)
+
+        self.queue.clear()
+        self.compiled.snapshots.read(self.runtime, data)
+        self.compiled.rearm(self.runtime)
 
     def add_transition(self, transition):
         assert False, "Cannot add transition to a statechart"
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import mmap
+import os
+
+from collections import OrderedDict
+
+from snapshot import HEADER
+from snapshot import MAGIC
+from transition import Event
+
+class MappedStore(object):
+
+    """
+        Keeps the configurations of a population of instances of a compiled
+        statechart in a memory mapped file of fixed width snapshot records,
+        instance i being at i * record size. An instance is loaded on its
+        first event, started if its record is still empty, and stays loaded
+        until it is evicted from a cache of cache_size runtimes. Changed
+        instances are written back to the mapping when evicted or flushed;
+        flush() also syncs the file, automatically every flush_every events
+        if it is set.
+
+        param(instance) returns the parameter passed to the actions of an
+        instance, by default they get None.
+    """
+
+    def __init__(self, compiled, path, count, param=None, cache_size=1024,
+                 flush_every=None):
+        self.compiled = compiled
+        self.snapshots = compiled.snapshots
+        self.count = count
+        self.param = param
+        self.cache_size = cache_size
+        self.flush_every = flush_every
+        self.dispatches = 0
+
+        self.loaded = OrderedDict()
+        self.dirty = set()
+
+        size = count * self.snapshots.size
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+
+        self.file = open(path, 'r+b')
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() < size:
+            self.file.truncate(size)
+
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def param_for(self, instance):
+        if self.param == None:
+            return None
+
+        return self.param(instance)
+
+    def offset(self, instance):
+        assert 0 <= instance < self.count, "Instance %d not in store" % instance
+        return instance * self.snapshots.size
+
+    def is_empty(self, instance):
+        magic = HEADER.unpack_from(self.map, self.offset(instance))[0]
+        return magic != MAGIC
+
+    def load(self, instance):
+        runtime = self.loaded.pop(instance, None)
+        if runtime != None:
+            self.loaded[instance] = runtime
+            return runtime
+
+        runtime = self.compiled.new_runtime()
+        if self.is_empty(instance):
+            self.compiled.start(runtime, self.param_for(instance))
+            self.dirty.add(instance)
+        else:
+            self.snapshots.read(runtime, self.map, self.offset(instance))
+
+        self.loaded[instance] = runtime
+        if len(self.loaded) > self.cache_size:
+            self.evict()
+
+        return runtime
+
+    def evict(self):
+        instance, runtime = self.loaded.popitem(last=False)
+        if instance in self.dirty:
+            self.snapshots.write(runtime, self.map, self.offset(instance))
+            self.dirty.discard(instance)
+
+    def dispatch(self, instance, event):
+        if event is not None and not isinstance(event, Event):
+            event = Event.get(event)
+
+        runtime = self.load(instance)
+        id = self.compiled.dispatch(runtime, event, self.param_for(instance))
+        self.dirty.add(instance)
+
+        self.dispatches += 1
+        if self.flush_every and self.dispatches % self.flush_every == 0:
+            self.flush()
+
+        return id != -1
+
+    def snapshot(self, instance):
+        if instance in self.loaded:
+            return self.snapshots.snapshot(self.loaded[instance])
+
+        offset = self.offset(instance)
+        return bytes(self.map[offset:offset + self.snapshots.size])
+
+    def flush(self):
+        for instance in self.dirty:
+            runtime = self.loaded.get(instance)
+            if runtime != None:
+                self.snapshots.write(runtime, self.map, self.offset(instance))
+
+        self.dirty.clear()
+        self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.loaded.clear()
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+import time
+
+from transition import Event
+
+try:
+    default_clock = time.monotonic
+except AttributeError:
+    default_clock = time.time
+
+class After(Event):
+
+    """
+        Event of a transition taken once its start state has been active
+        for delay seconds. It is only dispatched by the timer armed when
+        the state is entered. State.add_transition binds it to the state,
+        its id then holds the position of the state in the statechart, so
+        that the same statechart built anywhere gets the same ids.
+    """
+
+    __slots__ = ('delay', 'path')
+
+    def __new__(cls, delay, path=None):
+        return Event.__new__(cls, None)
+
+    def __init__(self, delay, path=None):
+        self.id = ('after', path, delay)
+        self.delay = delay
+        self.path = path
+
+    def bind(self, state):
+        """ The event of the transitions after delay from state """
+        path = []
+        while state.context != None:
+            path.append(state.context.substates.index(state))
+            state = state.context
+
+        return After(self.delay, tuple(reversed(path)))
+
+    def __reduce__(self):
+        return (After, (self.delay, self.path))
+
+def after(delay):
+    return After(delay)
+
+class VirtualClock(object):
+
+    """ Clock for TimingWheel that only moves when told to, for tests """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class Timer(object):
+
+    __slots__ = ('tick', 'callback', 'args')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+
+class TimingWheel(object):
+
+    """
+        Hashed timing wheel shared by any number of statecharts. A timer
+        due at tick t sits in bucket t modulo size, with the timers of the
+        later rounds, so scheduling and cancelling are a set insertion and
+        removal. Nothing runs on its own: expire() fires the timers that
+        are due, it is meant to be called from the event loop of the
+        application at least once per resolution seconds.
+    """
+
+    def __init__(self, resolution=0.1, size=1024, clock=None):
+        self.resolution = resolution
+        self.size = size
+        self.clock = clock or default_clock
+        self.buckets = [set() for i in range(size)]
+        self.count = 0
+
+        """ The last tick processed """
+        self.tick = self.ticks(self.clock())
+
+    def ticks(self, now):
+        return int(now / self.resolution)
+
+    def schedule(self, delay, callback, *args):
+        """ Calls callback(*args) once delay seconds have passed """
+        tick = max(self.ticks(self.clock() + delay), self.tick + 1)
+        timer = Timer(tick, callback, args)
+
+        self.buckets[tick % self.size].add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        bucket = self.buckets[timer.tick % self.size]
+        if timer in bucket:
+            bucket.remove(timer)
+            self.count -= 1
+
+    def expire(self):
+        """ Fires the timers due by now, returns how many fired """
+        target = self.ticks(self.clock())
+        fired = 0
+
+        while self.tick < target:
+            if self.count == 0:
+                self.tick = target
+                break
+
+            self.tick += 1
+            bucket = self.buckets[self.tick % self.size]
+            if not bucket:
+                continue
+
+            due = [timer for timer in bucket if timer.tick <= self.tick]
+            for timer in due:
+                """ A callback may cancel the timers still due """
+                if timer in bucket:
+                    bucket.remove(timer)
+                    self.count -= 1
+                    timer.callback(*timer.args)
+                    fired += 1
+
+        return fired
+
+    def __len__(self):
+        return self.count
+
+class Timers(object):
+
+    """
+        The timers of one run of a statechart, see State.timeouts. They are
+        armed when their state is entered and cancelled when it is exited,
+        and call dispatch(event) when they expire. dispatch may be replaced
+        while timers are armed, see journal.Journal.attach.
+    """
+
+    __slots__ = ('wheel', 'dispatch', 'armed')
+
+    def __init__(self, wheel, dispatch):
+        self.wheel = wheel
+        self.dispatch = dispatch
+        self.armed = {}
+
+    def arm(self, state):
+        expire = self.expire
+        self.armed[state] = [self.wheel.schedule(event.delay, expire, event)
+                             for event in state.timeouts]
+
+    def expire(self, event):
+        self.dispatch(event)
+
+    def cancel(self, state):
+        for timer in self.armed.pop(state, ()):
+            self.wheel.cancel(timer)
+
+    def clear(self):
+        for state in list(self.armed):
+            self.cancel(state)
@@ -1,26 +1,92 @@
 #!/usr/bin/env python
 
-from action import Action
-from states import Statechart
-
 class Event(object):
+
+    __slots__ = ('id',)
+
+    """ 
+        Interned Event objects, keyed by id. The ids used by a statechart
+        form a small closed set so the registry does not need eviction.
+    """
+    registry = {}
+
+    def __new__(cls, id):
+        if cls is not Event:
+            return object.__new__(cls)
+
+        event = Event.registry.get(id)
+        if event is None:
+            event = object.__new__(cls)
+            event.id = id
+            Event.registry[id] = event
+
+        return event
+
     def __init__(self, id):
         self.id = id
 
+    @classmethod
+    def get(cls, id):
+        """ Returns the interned event for an id, events are passed through """
+        if isinstance(id, Event):
+            return id
+
+        return cls(id)
+
     def __eq__(self, event):
-        if event == None:
+        if self is event:
+            return True
+
+        if event is None:
             return False                
 
-        return self.id == event.id
+        return self.id == getattr(event, 'id', event)
 
     def __ne__(self, event):
         return not self.__eq__(event)
 
+    def __hash__(self):
+        return hash(self.id)
+
+    def __reduce__(self):
+        return (self.__class__, (self.id,))
+
     def __str__(self):
         return "Event:%s" % str(self.id)
 
 class Guard(object):
+
+	""" 
+		A pure guard only depends on the param, its result is cached by
+		check_guard until a transition fires or the param changes.
+	"""
+	pure = False
+
 	def check(self, runtime, param):
 		raise NotImplementedError
 
+def check_guard(guard, runtime, param):
+    if not guard.pure:
+        return guard.check(runtime, param)
+
+    cached = cached_guard(guard, runtime)
+    if cached != None:
+        return cached[0]
+
+    result = guard.check(runtime, param)
+    runtime.guards[guard] = (runtime.version, result)
+    return result
+
+def cached_guard(guard, runtime):
+    """ 
+        (result,) of a pure guard checked since the param last changed, or
+        None. Results are tagged with the param version they were computed
+        for.
+    """
+    cached = runtime.guards.get(guard)
+    if cached != None and cached[0] == runtime.version:
+        return (cached[1],)
+
+    return None
+
 
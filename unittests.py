@@ -5,7 +5,15 @@ __copyright__   = "Copyright 2010 - 2011, Vishal Patil"
 __license__     = "New-style BSD"
 
 import re
+import sys
+import random
 import unittest
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from states import State
 from states import HierarchicalState
@@ -15,8 +23,11 @@ from states import Statechart
 from pseudostates import StartState 
 from pseudostates import EndState 
 from pseudostates import HistoryState 
+from runtime import CompactRuntimeData
 from action import Action
 from transition import Event
+from transition import Guard
+from eventqueue import RAISE
 
 class TestParam(object):
 
@@ -68,14 +79,29 @@ class TestExitClassAction(TestClassAction):
         TestClassAction.__init__(self, state_name)
         self.action_name = "exit" 
 
+class TestGuard(Guard):
+
+    def __init__(self, status):
+        self.status = status
+
+    def check(self, runtime, param):
+        return self.status
+
 class Base(unittest.TestCase):
 
+    compile = False
+    trusted = False
+
     def create_statechart(self, param):       
         raise NotImplementedError("Create statechart not implemented")
 
     def dispatch_events(self, events, expected_path):
         param   = TestParam()
         state_chart = self.create_statechart(param)
+        if self.trusted:
+            state_chart.trust()
+        if self.compile:
+            state_chart.compile()
         state_chart.start()
         for event in events:
             state_chart.dispatch(Event(event))
@@ -303,5 +329,1756 @@ class ConcurrentTest(Base):
                         "F:exit B:exit D:exit A:exit X:exit B:C C:entry C:do start_c:history_c J:entry J:do")
         self.dispatch_events(events, expected_path)
 
+class CompiledFSMTest(FSMTest):
+    compile = True
+
+class CompiledHSMTest(HSMTest):
+    compile = True
+
+class CompiledConcurrentTest(ConcurrentTest):
+    compile = True
+
+class TrustedFSMTest(FSMTest):
+    trusted = True
+
+class TrustedHSMTest(HSMTest):
+    trusted = True
+
+class TrustedConcurrentTest(ConcurrentTest):
+    trusted = True
+
+class CompiledStatechartTest(unittest.TestCase):
+
+    def testStateIds(self):
+        state_chart = HSMTest('testStart').create_statechart(TestParam())
+        compiled = state_chart.compile()
+
+        self.assertEquals(compiled.states[0], state_chart)
+        for state in compiled.states[1:]:
+            self.assertTrue(state.context.state_id < state.state_id)
+
+    def testCompactRuntime(self):
+        state_chart = HSMTest('testStart').create_statechart(TestParam())
+        state_chart.compile()
+        state_chart.start()
+        state_chart.dispatch(Event(1))
+
+        runtime = state_chart.runtime
+        A = state_chart.start_state.transitions[0].end
+        B = A.start_state.transitions[0].end
+        D = B.history.transitions[0].end.transitions[0].end
+
+        self.assertTrue(isinstance(runtime, CompactRuntimeData))
+        self.assertTrue(runtime.is_active(A))
+        self.assertTrue(runtime.is_active(D))
+        self.assertEquals(runtime.get_current_state(A), B)
+        self.assertEquals(runtime.get_current_state(B), D)
+        self.assertFalse(runtime.has_history_info(B.history))
+
+        state_chart.dispatch(Event(7))
+        self.assertFalse(runtime.is_active(B))
+        self.assertEquals(runtime.get_history_state(B.history), D)
+
+    def testFrozen(self):
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(TestParam())
+        state_chart.compile()
+        A = state_chart.start_state.transitions[0].end
+        self.assertRaises(AssertionError, Transition, A, A, Event(1),
+                          None, None)
+
+class DifferentialTest(unittest.TestCase):
+
+    """ The compiled executor against the interpreter, on random charts """
+
+    def build(self, seed, param):
+        rng = random.Random(seed)
+        state_chart = Statechart(param)
+        states = []
+
+        def fill(context, depth):
+            children = []
+            for i in range(rng.randint(1, 3)):
+                name = "S%d" % len(states)
+                actions = (TestEntryClassAction(name), None,
+                           TestExitClassAction(name))
+                kind = rng.random()
+                if depth < 3 and kind < 0.4:
+                    state = HierarchicalState(context, *actions)
+                    fill(state, depth + 1)
+                elif depth < 3 and kind < 0.55:
+                    state = ConcurrentState(context, *actions)
+                    for j in range(2):
+                        fill(HierarchicalState(state, None, None, None),
+                             depth + 2)
+                else:
+                    state = State(context, *actions)
+                state.name = name
+                states.append(state)
+                children.append(state)
+            Transition(StartState(context), rng.choice(children), None,
+                       None, None)
+
+        fill(state_chart, 0)
+
+        """ Many of these join a state to an ancestor or a descendant """
+        for i in range(rng.randint(2, 10)):
+            start = rng.choice(states)
+            end = rng.choice(states)
+            Transition(start, end, Event(rng.randrange(4)), None,
+                       TestTransitionAction(start.name, end.name))
+
+        return state_chart, states
+
+    def run_chart(self, seed, compile):
+        param = TestParam()
+        state_chart, states = self.build(seed, param)
+        if compile:
+            state_chart.compile()
+        state_chart.start()
+
+        rng = random.Random(seed)
+        for i in range(12):
+            state_chart.dispatch(rng.randrange(4))
+
+        return param.path, [state.name for state in states
+                            if state_chart.is_in(state)]
+
+    def testRandomCharts(self):
+        for seed in range(200):
+            self.assertEquals(self.run_chart(seed, True),
+                              self.run_chart(seed, False), seed)
+
+    def testAncestorTransitions(self):
+        for compile in (False, True):
+            param = TestParam()
+            state_chart = Statechart(param)
+            start = StartState(state_chart)
+            H = HierarchicalState(state_chart, TestEntryClassAction("H"),
+                                  None, TestExitClassAction("H"))
+            A = State(H, TestEntryClassAction("A"), None,
+                      TestExitClassAction("A"))
+            B = State(H, TestEntryClassAction("B"), None,
+                      TestExitClassAction("B"))
+            Transition(start, H, None, None, None)
+            Transition(StartState(H), A, None, None, None)
+            Transition(H, B, Event(1), None, None)
+            Transition(H, H, Event(2), None, None)
+            Transition(B, H, Event(3), None, None)
+
+            if compile:
+                state_chart.compile()
+            state_chart.start()
+            for event in [1, 2, 1, 3]:
+                state_chart.dispatch(event)
+
+            self.assertEquals(param.path, "H:entry A:entry " +
+                              "A:exit H:exit H:entry B:entry " +
+                              "B:exit H:exit H:entry A:entry " +
+                              "A:exit H:exit H:entry B:entry " +
+                              "B:exit H:exit H:entry A:entry")
+
+class SpawnTest(unittest.TestCase):
+
+    def testIndependentInstances(self):
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(None)
+        first = state_chart.spawn(TestParam())
+        second = state_chart.spawn(TestParam())
+        self.assertTrue(first.compiled is second.compiled)
+
+        first.start()
+        second.start()
+        for event in [1, 2, 3]:
+            first.dispatch(event)
+        second.dispatch(1)
+
+        self.assertEquals(first.param.path, ("start:A A:entry A:do " + 
+                                       "A:exit A:B B:entry B:do " + 
+                                       "B:exit B:B B:entry B:do " + 
+                                       "B:exit B:end"))
+        self.assertEquals(second.param.path, ("start:A A:entry A:do " + 
+                                       "A:exit A:B B:entry B:do"))
+
+class BatchDispatchTest(unittest.TestCase):
+
+    def testDispatchMany(self):
+        param = TestParam()
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(param)
+        compiled = state_chart.compile()
+        state_chart.start()
+
+        results = state_chart.dispatch_many([1, 99, Event(2), 3])
+        self.assertEquals(len(results), 4)
+        self.assertEquals(results[1], -1)
+
+        A = state_chart.start_state.transitions[0].end
+        self.assertEquals(compiled.transitions[results[0]].transition,
+                          A.transitions[0])
+        self.assertEquals(param.path, ("start:A A:entry A:do " + 
+                                       "A:exit A:B B:entry B:do " + 
+                                       "B:exit B:B B:entry B:do " + 
+                                       "B:exit B:end"))
+
+    def testDispatchStream(self):
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(None)
+        instance = state_chart.spawn(TestParam())
+        instance.start()
+
+        events = (event for event in [1, 2, 5])
+        results = list(instance.dispatch_stream(events))
+        self.assertEquals(results[2], -1)
+        self.assertNotEquals(results[0], -1)
+        self.assertNotEquals(results[1], -1)
+
+    def testNotCompiled(self):
+        param = TestParam()
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(param)
+        state_chart.start()
+
+        self.assertRaises(RuntimeError, state_chart.dispatch_many, [1, 2])
+        self.assertRaises(RuntimeError, state_chart.dispatch_stream, [1, 2])
+        self.assertEquals(param.path, "start:A A:entry A:do")
+
+        self.assertTrue(state_chart.dispatch(1))
+
+    def testFromAction(self):
+        class Batch(Action):
+            def execute(self, param):
+                for batch in (param.chart.dispatch_many,
+                              param.chart.dispatch_stream):
+                    try:
+                        list(batch([3]))
+                    except RuntimeError:
+                        param.path += " refused"
+                param.chart.dispatch(2)
+
+        for spawn in (False, True):
+            param = TestParam()
+            state_chart = Statechart(param)
+            start = StartState(state_chart)
+            A = State(state_chart, None, None, None)
+            B = State(state_chart, None, None, None)
+            C = State(state_chart, TestEntryClassAction("C"), None, None)
+            Transition(start, A, None, None, None)
+            Transition(A, B, Event(1), None, Batch())
+            Transition(B, C, Event(2), None, None)
+            Transition(A, C, Event(3), None, None)
+
+            if spawn:
+                param.chart = state_chart.spawn(param)
+            else:
+                state_chart.compile()
+                param.chart = state_chart
+            param.chart.start()
+
+            """ The event dispatched after the refusals is still queued """
+            self.assertTrue(param.chart.dispatch(1))
+            self.assertEquals(param.path, "refused refused C:entry")
+            self.assertTrue(param.chart.is_in(C))
+
+class VectorizedTest(unittest.TestCase):
+
+    def create_statechart(self):
+        """ Hierarchical chart, only the transitions on event 4 need Python """
+        state_chart = Statechart(None)
+        start = StartState(state_chart)
+        A = HierarchicalState(state_chart, None, None, None)
+        start_a = StartState(A)
+        B = HierarchicalState(A, None, None, None)
+        start_b = StartState(B)
+        history_b = HistoryState(B)
+        C = State(B, None, None, None)
+        D = State(B, None, None, None)
+        E = State(A, None, None, None)
+        F = State(state_chart, TestEntryClassAction("F"), None, None)
+
+        Transition(start, A, None, None, None)
+        Transition(start_a, B, None, None, None)
+        Transition(start_b, C, None, None, None)
+        Transition(history_b, C, None, None, None)
+        Transition(C, D, Event(1), None, None)
+        Transition(D, C, Event(1), None, None)
+        Transition(B, E, Event(2), None, None)
+        Transition(E, history_b, Event(3), None, None)
+        Transition(A, F, Event(4), TestGuard(True), None)
+        Transition(F, A, Event(5), None, None)
+        return state_chart
+
+    @unittest.skipIf(numpy == None, "numpy is not installed")
+    def testMatchesCompiled(self):
+        from vectorized import VectorizedStatechart
+
+        state_chart = self.create_statechart()
+        compiled = state_chart.compile()
+
+        count = 20
+        params = [TestParam() for i in range(count)]
+        engine = VectorizedStatechart(compiled, count, params)
+        engine.start()
+        instances = [compiled.spawn(TestParam()) for i in range(count)]
+        for instance in instances:
+            instance.start()
+
+        rng = random.Random(7)
+        for tick in range(30):
+            targets = [rng.randrange(count) for i in range(15)]
+            events = [rng.randrange(1, 7) for i in range(15)]
+            results = engine.dispatch(targets, events)
+
+            expected = [instances[t].compiled.dispatch(instances[t].runtime,
+                            Event(e), instances[t].param)
+                        for t, e in zip(targets, events)]
+            self.assertEquals(results.tolist(), expected)
+
+        for i in range(count):
+            runtime = instances[i].runtime
+            if engine.leaves[i] == -1:
+                self.assertEquals(engine.runtimes[i].active, runtime.active)
+            else:
+                self.assertEquals(engine.leaves[i], runtime.leaves[0])
+                self.assertEquals(engine.history[i].tolist(),
+                                  runtime.history.tolist())
+            self.assertEquals(params[i].path, instances[i].param.path)
+
+class TestPostAction(TestClassAction):
+
+    """ Dispatches an event to the statechart from an entry action """
+
+    def __init__(self, state_name, event):
+        TestClassAction.__init__(self, state_name)
+        self.action_name = "entry"
+        self.event = event
+
+    def execute(self, parameter):
+        TestClassAction.execute(self, parameter)
+        parameter.chart.dispatch(self.event)
+        parameter.path = ("%s %s:posted" % (parameter.path, 
+                                            self.state_name)).strip()
+
+class TestPostEventsAction(Action):
+
+    """ Posts events to the statechart from an entry action """
+
+    def __init__(self, events):
+        self.events = events
+
+    def execute(self, parameter):
+        for event in self.events:
+            parameter.chart.post(event)
+
+def create_bounded_statechart(param, queue_size=None, overflow=RAISE):
+    """ A posts 1 and 2, which end in B or C if the other is dropped """
+    state_chart = Statechart(param, queue_size, overflow)
+    start = StartState(state_chart)
+    A = State(state_chart, TestPostEventsAction([1, 2]), None, None)
+    B = State(state_chart, TestEntryClassAction("B"), None, None)
+    C = State(state_chart, TestEntryClassAction("C"), None, None)
+    Transition(start, A, None, None, None)
+    Transition(A, B, Event(1), None, None)
+    Transition(A, C, Event(2), None, None)
+    Transition(B, C, Event(2), None, None)
+    return state_chart
+
+class RunToCompletionTest(unittest.TestCase):
+
+    def create_statechart(self, param):
+        state_chart = Statechart(param)
+        start = StartState(state_chart)
+        A = State(state_chart, TestPostAction("A", 1), None, None)
+        B = State(state_chart, TestPostAction("B", 2), None, None)
+        C = State(state_chart, TestEntryClassAction("C"), None, None)
+        Transition(start, A, None, None, None)
+        Transition(A, B, Event(1), None, None)
+        Transition(B, C, Event(2), None, None)
+        return state_chart
+
+    def testPostedEvents(self):
+        for compile in (False, True):
+            param = TestParam()
+            state_chart = self.create_statechart(param)
+            if compile:
+                param.chart = state_chart.spawn(param)
+            else:
+                param.chart = state_chart
+            param.chart.start()
+
+            self.assertEquals(param.path, 
+                "A:entry A:posted B:entry B:posted C:entry")
+            self.assertEquals(len(param.chart.queue), 0)
+
+    def testOverflow(self):
+        from eventqueue import EventQueue, EventQueueFull
+        from eventqueue import DROP_NEWEST, DROP_OLDEST
+
+        queue = EventQueue(2)
+        queue.put(1)
+        queue.put(2)
+        self.assertRaises(EventQueueFull, queue.put, 3)
+
+        queue = EventQueue(2, DROP_NEWEST)
+        for event in [1, 2, 3]:
+            queue.put(event)
+        self.assertEquals([queue.get(), queue.get()], [1, 2])
+        self.assertEquals(queue.dropped, 1)
+
+        queue = EventQueue(2, DROP_OLDEST)
+        for event in [1, 2, 3]:
+            queue.put(event)
+        self.assertEquals([queue.get(), queue.get()], [2, 3])
+
+    def testBoundedQueue(self):
+        from eventqueue import EventQueueFull
+        from eventqueue import DROP_NEWEST, DROP_OLDEST
+
+        for compile in (False, True):
+            for overflow, path in ((DROP_NEWEST, "B:entry"),
+                                   (DROP_OLDEST, "C:entry")):
+                param = TestParam()
+                if compile:
+                    state_chart = create_bounded_statechart(param)
+                    param.chart = state_chart.spawn(param, 1, overflow)
+                else:
+                    param.chart = create_bounded_statechart(param, 1,
+                                                            overflow)
+                param.chart.start()
+
+                self.assertEquals(param.path, path)
+                self.assertEquals(param.chart.queue.dropped, 1)
+
+            param = TestParam()
+            if compile:
+                state_chart = create_bounded_statechart(param)
+                param.chart = state_chart.spawn(param, 1, RAISE)
+            else:
+                param.chart = create_bounded_statechart(param, 1, RAISE)
+            self.assertRaises(EventQueueFull, param.chart.start)
+
+            param = TestParam()
+            param.chart = create_bounded_statechart(param)
+            param.chart.start()
+            self.assertEquals(param.path, "B:entry C:entry")
+
+class DispatcherTest(unittest.TestCase):
+
+    def testPerInstanceOrder(self):
+        from dispatcher import Dispatcher
+
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(None)
+        compiled = state_chart.compile()
+        dispatcher = Dispatcher(lambda key: compiled.spawn(TestParam()), 3)
+        dispatcher.start()
+
+        keys = range(10)
+        for event in [1, 8, 4, 5, 2, 5, 6, 4, 7, 1, 2, 3]:
+            dispatcher.dispatch_many([(key, event) for key in keys])
+        dispatcher.join()
+        dispatcher.stop()
+
+        self.assertEquals(dispatcher.failures, [])
+        for key in keys:
+            self.assertEquals(dispatcher.instance(key).param.path,
+                         ("start:A A:entry A:do " +
+                         "A:exit A:B B:entry B:do " +
+                         "B:exit B:C C:entry C:do " +
+                         "C:exit C:C C:entry C:do " +
+                         "C:exit C:C C:entry C:do " +
+                         "C:exit C:B B:entry B:do " +
+                         "B:exit B:C C:entry C:do " +
+                         "C:exit C:A A:entry A:do " +
+                         "A:exit A:B B:entry B:do " +
+                         "B:exit B:B B:entry B:do " +
+                         "B:exit B:end"))
+
+    def testFailedStart(self):
+        from dispatcher import Dispatcher
+
+        class Failing(Action):
+            def execute(self, param):
+                if param.fail:
+                    param.fail = False
+                    raise ValueError("entry of A")
+                param.path = "A:entry"
+
+        state_chart = Statechart(None)
+        start = StartState(state_chart)
+        A = State(state_chart, Failing(), None, None)
+        B = State(state_chart, TestEntryClassAction("B"), None, None)
+        Transition(start, A, None, None, None)
+        Transition(A, B, Event(1), None, None)
+        compiled = state_chart.compile()
+
+        """ The first start fails, the second event starts it again """
+        param = TestParam()
+        param.fail = True
+        dispatcher = Dispatcher(lambda key: compiled.spawn(param), 1)
+        dispatcher.start()
+        dispatcher.dispatch("key", 1)
+        dispatcher.dispatch("key", 1)
+        dispatcher.join()
+        dispatcher.stop()
+
+        self.assertEquals(len(dispatcher.failures), 1)
+        self.assertTrue(isinstance(dispatcher.failures[0][1], ValueError))
+        self.assertEquals(param.path, "A:entry B:entry")
+
+class ParallelRegionsTest(unittest.TestCase):
+
+    def active_states(self, state_chart):
+        """ Positions of the active states, in pre-order """
+        states = []
+        pending = [state_chart]
+        while pending:
+            state = pending.pop()
+            states.append(state)
+            pending.extend(reversed(getattr(state, 'substates', [])))
+
+        return set([i for i, state in enumerate(states)
+                    if state_chart.runtime.is_active(state)])
+
+    def run_events(self, pool, compile):
+        state_chart = ConcurrentTest('testStartStates').create_statechart(
+                                                             TestParam())
+        X = state_chart.start_state.transitions[0].end
+        if pool:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                X.set_parallel(pool)
+            self.assertTrue(caught)
+            self.assertTrue("leaves region" in str(caught[0].message))
+
+        if compile:
+            state_chart.compile()
+        state_chart.start()
+        for event in [1, 6, 2, 8, 2]:
+            state_chart.dispatch(event)
+
+        return self.active_states(state_chart)
+
+    def testSameConfiguration(self):
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(2)
+        try:
+            for compile in (False, True):
+                expected = self.run_events(None, compile)
+                self.assertEquals(len(expected), 6)
+                self.assertEquals(self.run_events(pool, compile), expected)
+        finally:
+            pool.close()
+            pool.join()
+
+class SnapshotTest(unittest.TestCase):
+
+    def testRestore(self):
+        state_chart = HSMTest('testHistory').create_statechart(None)
+        first = state_chart.spawn(TestParam())
+        first.start()
+        first.dispatch_many([1, 7, 6, 4])
+
+        data = first.snapshot()
+        self.assertEquals(len(data), state_chart.compiled.snapshots.size)
+
+        second = state_chart.spawn(TestParam())
+        second.restore(data)
+        self.assertEquals(second.param.path, "")
+
+        first.param.path = ""
+        first.dispatch_many([7, 6, 4, 2, 3, 5])
+        second.dispatch_many([7, 6, 4, 2, 3, 5])
+        self.assertEquals(second.param.path, first.param.path)
+        self.assertEquals(second.snapshot(), first.snapshot())
+
+    def testBulkAndMismatch(self):
+        from snapshot import SnapshotError
+
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(None)
+        compiled = state_chart.compile()
+        snapshots = compiled.snapshots
+
+        instances = [compiled.spawn(TestParam()) for i in range(3)]
+        for i, instance in enumerate(instances):
+            instance.start()
+            instance.dispatch_many([1, 4][:i])
+
+        buffer = bytearray(3 * snapshots.size)
+        snapshots.write_many([i.runtime for i in instances], buffer)
+        for i, instance in enumerate(instances):
+            restored = compiled.spawn(TestParam())
+            restored.restore(buffer[i * snapshots.size:])
+            self.assertEquals(restored.snapshot(), instance.snapshot())
+
+        """ Read in place from a mapping, which can be closed afterwards """
+        import mmap
+        mapped = mmap.mmap(-1, 3 * snapshots.size)
+        snapshots.write_many([i.runtime for i in instances], mapped)
+        for i, instance in enumerate(instances):
+            runtime = compiled.new_runtime()
+            self.assertEquals(snapshots.read(runtime, mapped,
+                                             i * snapshots.size),
+                              (i + 1) * snapshots.size)
+            self.assertEquals(snapshots.snapshot(runtime),
+                              instance.snapshot())
+        mapped.close()
+
+        other = HSMTest('testHistory').create_statechart(None)
+        other.compile()
+        self.assertRaises(SnapshotError, other.restore, 
+                          instances[0].snapshot())
+
+class MappedStoreTest(unittest.TestCase):
+
+    def testPersistence(self):
+        import os
+        import shutil
+        import tempfile
+        from store import MappedStore
+
+        state_chart = HSMTest('testHistory').create_statechart(None)
+        compiled = state_chart.compile()
+        events = [1, 7, 6, 4, 7, 6, 4, 2, 3, 5]
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "instances.db")
+            store = MappedStore(compiled, path, 6, lambda i: TestParam(),
+                                cache_size=2)
+            for event in events:
+                for instance in range(5):
+                    store.dispatch(instance, event)
+            store.close()
+
+            expected = compiled.spawn(TestParam())
+            expected.start()
+            expected.dispatch_many(events)
+
+            store = MappedStore(compiled, path, 6)
+            for instance in range(5):
+                self.assertEquals(store.snapshot(instance),
+                                  expected.snapshot())
+            self.assertTrue(store.is_empty(5))
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+class JournalTest(unittest.TestCase):
+
+    def testReplay(self):
+        import io
+        from journal import Journal
+        from journal import JournalError
+        from journal import Replay
+
+        state_chart = ConcurrentTest('testConcurrentStates').create_statechart(
+                                                                        None)
+        compiled = state_chart.compile()
+        instance = compiled.spawn(TestParam())
+        instance.start()
+
+        journal = Journal(io.BytesIO())
+        for event in [1, 2, 5]:
+            journal.dispatch(instance, event)
+
+        snapshot = instance.snapshot()
+        offset = journal.mark()
+        for event in [10, 15, 6, 1, 2, 5]:
+            journal.dispatch(instance, event)
+
+        records = list(journal.records(offset))
+        self.assertEquals([event.id for event, ids in records],
+                          [10, 15, 6, 1, 2, 5])
+        self.assertTrue(len(records[1][1]) > 1)
+
+        replay = Replay(compiled)
+        param = TestParam()
+        quiet = replay.restore(snapshot, journal, offset, param)
+        self.assertEquals(param.path, "")
+        self.assertEquals(compiled.snapshots.snapshot(quiet), 
+                          instance.snapshot())
+
+        loud = replay.restore(snapshot, journal, offset, param, actions=True)
+        self.assertTrue(param.path.endswith("C:entry C:do start_c:history_c "
+                                            "J:entry J:do"))
+        self.assertEquals(compiled.snapshots.snapshot(loud), 
+                          instance.snapshot())
+
+        """ The journal does not follow on from a snapshot of the start """
+        started = compiled.spawn(TestParam())
+        started.start()
+        self.assertRaises(JournalError, replay.restore, started.snapshot(),
+                          journal, offset)
+
+    def testEnteredRegion(self):
+        import io
+        from journal import Journal
+        from journal import Replay
+
+        state_chart = Statechart(None)
+        start = StartState(state_chart)
+        S = State(state_chart, None, None, None)
+        X = ConcurrentState(state_chart, None, None, None)
+        Transition(start, S, None, None, None)
+
+        targets = []
+        for i in range(2):
+            R = HierarchicalState(X, None, None, None)
+            A = State(R, None, None, None)
+            B = State(R, None, None, None)
+            Transition(StartState(R), A, None, None, None)
+            targets.append(B)
+
+        """ The region of B is entered by the transition, not from start """
+        Transition(S, targets[0], Event(1), None, None)
+
+        compiled = state_chart.compile()
+        instance = compiled.spawn(None)
+        instance.start()
+        snapshot = instance.snapshot()
+
+        journal = Journal(io.BytesIO())
+        journal.dispatch(instance, 1)
+
+        runtime = Replay(compiled).restore(snapshot, journal, 0)
+        self.assertEquals(compiled.snapshots.snapshot(runtime),
+                          instance.snapshot())
+
+class TestDeferredAction(Action):
+
+    """ Completes on a later iteration of the event loop """
+
+    def __init__(self, name, post=None):
+        self.name = name
+        self.post = post
+
+    def execute(self, parameter):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def done():
+            parameter.path = ("%s %s" % (parameter.path, self.name)).strip()
+            if self.post:
+                parameter.chart.post(self.post)
+            future.set_result(None)
+
+        loop.call_soon(done)
+        return future
+
+class TestDispatchAction(Action):
+
+    """ Waits for a dispatch to the statechart, from the action """
+
+    def __init__(self, event):
+        self.event = event
+
+    def execute(self, parameter):
+        return parameter.chart.dispatch(self.event)
+
+class TestDeferredGuard(Guard):
+
+    def check(self, runtime, param):
+        import asyncio
+        return asyncio.sleep(0, True)
+
+class AsyncTest(unittest.TestCase):
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio needs Python 3.7")
+    def testAwaitableActions(self):
+        import asyncio
+        from asyncchart import AsyncStatechart
+
+        state_chart = Statechart(None)
+        start = StartState(state_chart)
+        A = State(state_chart, TestDeferredAction("A:entry"), None,
+                  TestDeferredAction("A:exit"))
+        B = State(state_chart, TestDeferredAction("B:entry", 2), None, None)
+        C = State(state_chart, TestEntryClassAction("C"), None, None)
+        Transition(start, A, None, None, None)
+        Transition(A, B, Event(1), TestDeferredGuard(), 
+                   TestDeferredAction("A:B"))
+        Transition(B, C, Event(2), None, None)
+
+        param = TestParam()
+        chart = AsyncStatechart(state_chart.compile(), param)
+        param.chart = chart
+
+        async_loop = asyncio.new_event_loop()
+        try:
+            async_loop.run_until_complete(chart.start())
+            handled = async_loop.run_until_complete(chart.dispatch(1))
+        finally:
+            async_loop.close()
+
+        self.assertTrue(handled)
+        self.assertEquals(param.path, "A:entry A:exit A:B B:entry C:entry")
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio needs Python 3.7")
+    def testDispatchFromParallelRegion(self):
+        import asyncio
+        from asyncchart import AsyncStatechart
+
+        state_chart = Statechart(None)
+        start = StartState(state_chart)
+        X = ConcurrentState(state_chart, None, None, None)
+        Transition(start, X, None, None, None)
+
+        ends = []
+        for event, action in ((1, TestDispatchAction(2)), (2, None)):
+            R = HierarchicalState(X, None, None, None)
+            start_r = StartState(R)
+            A = State(R, None, None, None)
+            B = State(R, None, None, None)
+            Transition(start_r, A, None, None, None)
+            Transition(A, B, Event(event), None, action)
+            ends.append(B)
+        X.set_parallel()
+
+        param = TestParam()
+        chart = AsyncStatechart(state_chart.compile(), param)
+        param.chart = chart
+
+        """ The awaited dispatch is queued, not waited for """
+        async_loop = asyncio.new_event_loop()
+        try:
+            async_loop.run_until_complete(chart.start())
+            handled = async_loop.run_until_complete(
+                            asyncio.wait_for(chart.dispatch(1), 5))
+        finally:
+            async_loop.close()
+
+        self.assertTrue(handled)
+        for state in ends:
+            self.assertTrue(chart.runtime.is_active(state))
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio needs Python 3.7")
+    def testBoundedQueue(self):
+        import asyncio
+        from asyncchart import AsyncStatechart
+        from eventqueue import DROP_NEWEST
+
+        param = TestParam()
+        compiled = create_bounded_statechart(param).compile()
+        chart = AsyncStatechart(compiled, param, 1, DROP_NEWEST)
+        param.chart = chart
+
+        async_loop = asyncio.new_event_loop()
+        try:
+            async_loop.run_until_complete(chart.start())
+        finally:
+            async_loop.close()
+
+        self.assertEquals(param.path, "B:entry")
+        self.assertEquals(chart.queue.dropped, 1)
+
+    def run_parity(self, use_async):
+        import asyncio
+        from asyncchart import AsyncStatechart
+        from profiling import Listener
+        from timers import TimingWheel
+        from timers import VirtualClock
+
+        class Recorder(Listener):
+            def __init__(self):
+                self.calls = []
+            def fired(self, runtime, transition):
+                self.calls.append("fired")
+            def entered(self, runtime, state):
+                self.calls.append("entered")
+            def exited(self, runtime, state):
+                self.calls.append("exited")
+            def guard_checked(self, runtime, transition, result, elapsed):
+                self.calls.append("guard %s" % result)
+
+        clock = VirtualClock()
+        wheel = TimingWheel(resolution=1, size=8, clock=clock)
+        param = TestParam()
+        guard = CountingGuard()
+        state_chart = TimedTransitionTest('testCompiled').create_statechart(
+                                                                param, wheel)
+        C = state_chart.start_state.transitions[0].end.transitions[-1].end
+        Transition(C, C, Event(3), guard, None)
+        recorder = Recorder()
+        state_chart.add_listener(recorder)
+        compiled = state_chart.compile()
+
+        if use_async:
+            loop = asyncio.new_event_loop()
+            chart = AsyncStatechart(compiled, param)
+            run = loop.run_until_complete
+        else:
+            chart = compiled.spawn(param)
+            run = lambda result: result
+
+        try:
+            run(chart.start())
+            clock.advance(30)
+            if use_async:
+                """ The timer dispatches from the event loop """
+                loop.call_soon(wheel.expire)
+                for i in range(3):
+                    run(asyncio.sleep(0))
+            else:
+                wheel.expire()
+
+            for event in [1, 2, 3, 3]:
+                run(chart.dispatch(event))
+        finally:
+            if use_async:
+                loop.close()
+
+        return param.path, recorder.calls, guard.checks
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio needs Python 3.7")
+    def testSameAsInstance(self):
+        path, calls, checks = self.run_parity(True)
+        self.assertEquals((path, calls, checks), self.run_parity(False))
+        self.assertEquals(path, "A:entry B:entry A:entry C:entry")
+        self.assertEquals(checks, 1)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio needs Python 3.7")
+    def testFailedEvents(self):
+        import asyncio
+        from asyncchart import AsyncStatechart
+
+        class Failing(Guard):
+            def check(self, runtime, param):
+                raise ValueError("guard")
+
+        class Post(Action):
+            def execute(self, param):
+                param.chart.post(1)
+
+        state_chart = Statechart(None)
+        start = StartState(state_chart)
+        A = State(state_chart, None, None, None)
+        Transition(start, A, None, None, None)
+        Transition(A, A, Event(1), Failing(), None)
+        Transition(A, A, Event(2), None, Post())
+
+        param = TestParam()
+        chart = AsyncStatechart(state_chart.compile(), param)
+        param.chart = chart
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(chart.start())
+            tasks = [loop.create_task(chart.dispatch(event))
+                     for event in [1, 2, 2]]
+            loop.run_until_complete(asyncio.wait(tasks))
+        finally:
+            loop.close()
+
+        results = [task.exception() or task.result() for task in tasks]
+        self.assertTrue(isinstance(results[0], ValueError))
+        self.assertEquals(results[1:], [True, True])
+        self.assertEquals([event for event, e in chart.failures],
+                          [Event(1), Event(1)])
+
+class EventTest(unittest.TestCase):
+
+    def testInterned(self):
+        self.assertTrue(Event.get(1) is Event(1))
+        self.assertTrue(Event.get(Event(2)) is Event(2))
+        self.assertEquals(Event(1), 1)
+        self.assertNotEquals(Event(1), Event(2))
+        self.assertNotEquals(Event(1), None)
+        self.assertEquals({Event(1): 'a'}[1], 'a')
+
+    def testDispatchPlainIds(self):
+        param = TestParam()
+        state_chart = FSMTest('testSimpleFSM1').create_statechart(param)
+        state_chart.start()
+        for event in [1, 2, 3]:
+            state_chart.dispatch(event)
+        self.assertEquals(param.path, ("start:A A:entry A:do " + 
+                                       "A:exit A:B B:entry B:do " + 
+                                       "B:exit B:B B:entry B:do " + 
+                                       "B:exit B:end"))
+
+class DispatchIndexTest(unittest.TestCase):
+
+    def testCandidateOrder(self):
+        state_chart = Statechart(TestParam())
+        A = State(state_chart, None, None, None)
+        B = State(state_chart, None, None, None)
+
+        t1 = Transition(A, B, Event(1), None, None)
+        t2 = Transition(A, B, None, None, None)
+        t3 = Transition(A, B, Event(1), TestGuard(True), None)
+        t4 = Transition(A, B, Event(2), None, None)
+        t5 = Transition(A, B, Event(1), None, None)
+
+        self.assertEquals(A.get_transitions(Event(1)), [t3, t1, t2, t5])
+        self.assertEquals(A.get_transitions(Event(2)), [t2, t4])
+        self.assertEquals(A.get_transitions(Event(3)), [t2])
+        self.assertEquals(A.get_transitions(None), [t2])
+
+    def testIndexRebuiltOnAdd(self):
+        state_chart = Statechart(TestParam())
+        A = State(state_chart, None, None, None)
+        B = State(state_chart, None, None, None)
+
+        t1 = Transition(A, B, Event(1), None, None)
+        self.assertEquals(A.get_transitions(Event(1)), [t1])
+
+        t2 = Transition(A, B, Event(1), TestGuard(False), None)
+        self.assertEquals(A.get_transitions(Event(1)), [t2, t1])
+
+class CountingGuard(Guard):
+
+    pure = True
+
+    def __init__(self):
+        self.checks = 0
+
+    def check(self, runtime, param):
+        self.checks += 1
+        return param.path == "open"
+
+class GuardCacheTest(unittest.TestCase):
+
+    def create_statechart(self, param, guard):
+        state_chart = Statechart(param)
+        start = StartState(state_chart)
+        A = State(state_chart, None, None, None)
+        B = State(state_chart, None, None, None)
+
+        Transition(start, A, None, None, None)
+        Transition(A, B, Event(1), guard, None)
+        Transition(A, A, Event(2), None, None)
+        Transition(B, A, Event(3), None, None)
+        return state_chart
+
+    def check(self, compile):
+        param = TestParam()
+        guard = CountingGuard()
+        state_chart = self.create_statechart(param, guard)
+        if compile:
+            state_chart.compile()
+        state_chart.start()
+
+        for i in range(3):
+            self.assertFalse(state_chart.dispatch(1))
+        self.assertEquals(guard.checks, 1)
+
+        """ Unrelated events do not evaluate the guard """
+        state_chart.dispatch(4)
+        self.assertEquals(guard.checks, 1)
+
+        state_chart.dispatch(2)
+        self.assertFalse(state_chart.dispatch(1))
+        self.assertEquals(guard.checks, 2)
+
+        param.path = "open"
+        self.assertFalse(state_chart.dispatch(1))
+        state_chart.param_changed()
+        self.assertTrue(state_chart.dispatch(1))
+        self.assertEquals(guard.checks, 3)
+
+    def testInterpreted(self):
+        self.check(False)
+
+    def testCompiled(self):
+        self.check(True)
+
+    def testParallelRegions(self):
+        from multiprocessing.pool import ThreadPool
+
+        class Open(Action):
+            def execute(self, param):
+                param.path = "open"
+
+        pool = ThreadPool(2)
+        try:
+            for compile in (False, True):
+                param = TestParam()
+                guard = CountingGuard()
+                state_chart = Statechart(param)
+                start = StartState(state_chart)
+                X = ConcurrentState(state_chart, None, None, None)
+                Y = State(state_chart, None, None, None)
+                Transition(start, X, None, None, None)
+                Transition(X, Y, Event(9), guard, None)
+
+                for action in (Open(), None):
+                    R = HierarchicalState(X, None, None, None)
+                    start_r = StartState(R)
+                    A = State(R, None, None, None)
+                    B = State(R, None, None, None)
+                    Transition(start_r, A, None, None, None)
+                    Transition(A, B, Event(1), None, action)
+
+                X.set_parallel(pool)
+                if compile:
+                    state_chart.compile()
+                state_chart.start()
+
+                self.assertFalse(state_chart.dispatch(9))
+
+                """ The regions fire in forks of the runtime """
+                self.assertTrue(state_chart.dispatch(1))
+                self.assertTrue(state_chart.dispatch(9))
+                self.assertTrue(state_chart.is_in(Y))
+                self.assertEquals(guard.checks, 2)
+        finally:
+            pool.close()
+            pool.join()
+
+class ProfilerTest(unittest.TestCase):
+
+    def profile(self, compile):
+        from profiling import Profiler
+
+        state_chart = HSMTest('testHistory').create_statechart(TestParam())
+        profiler = Profiler()
+        state_chart.add_listener(profiler)
+        if compile:
+            state_chart.compile()
+
+        state_chart.start()
+        for event in [1, 7, 6, 4, 2, 3, 5]:
+            state_chart.dispatch(event)
+
+        return state_chart, profiler
+
+    def testCounts(self):
+        state_chart, interpreted = self.profile(False)
+        state_chart, compiled = self.profile(True)
+
+        """ start() dispatches once too """
+        self.assertEquals(interpreted.latency.count, 8)
+        self.assertEquals(compiled.latency.count, 8)
+
+        counts = lambda profiler: sorted(profiler.fire_counts.values())
+        self.assertEquals(counts(interpreted), counts(compiled))
+        self.assertTrue(sum(counts(compiled)) >= 7)
+
+        self.assertTrue(compiled.dwell_times)
+        self.assertTrue(compiled.action_times)
+        self.assertTrue(compiled.latency.percentile(99) <= 
+                        compiled.latency.maximum)
+
+        state_chart.remove_listener(compiled)
+        state_chart.dispatch(7)
+        self.assertEquals(compiled.latency.count, 8)
+
+    def testParallelRegions(self):
+        from multiprocessing.pool import ThreadPool
+        from profiling import Profiler
+
+        pool = ThreadPool(2)
+        try:
+            for compile in (False, True):
+                state_chart = ConcurrentTest('testStartStates'
+                                            ).create_statechart(TestParam())
+                X = state_chart.start_state.transitions[0].end
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    X.set_parallel(pool)
+
+                profiler = Profiler()
+                state_chart.add_listener(profiler)
+                if compile:
+                    state_chart.compile()
+
+                state_chart.start()
+                for event in [1, 6, 2, 8, 2]:
+                    state_chart.dispatch(event)
+
+                """ The states exited in the regions were all timed """
+                A, B = X.regions
+                D, E = A.substates[2:]
+                F, G, H = B.substates[2:]
+                for state in (E, G, H):
+                    self.assertTrue(state in profiler.dwell_times)
+
+                owners = set([key[0] for key in profiler.entered_at])
+                self.assertEquals(len(owners), 1)
+                self.assertEquals(set([key[1] for key in profiler.entered_at]),
+                                  set([state for state in (X, A, B, D, E, F, G,
+                                                           H)
+                                       if state_chart.is_in(state)]))
+        finally:
+            pool.close()
+            pool.join()
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testSmallRun(self):
+        import benchmarks
+
+        results = benchmarks.run(width=2, depth=2, regions=2, count=200,
+                                 repeat=1, instances=10)
+        self.assertEquals(results['transitions'], 1 + 2 * (1 + 2 + 4 * 2))
+        self.assertTrue(results['compiled_events_per_second'] > 0)
+
+        slower = dict(results)
+        slower['batch_events_per_second'] /= 2.0
+        regressions = [name for name, old, new, change, regressed
+                       in benchmarks.compare(slower, results) if regressed]
+        self.assertEquals(regressions, ['batch_events_per_second'])
+
+class AncestryTest(unittest.TestCase):
+
+    def testChangedStates(self):
+        state_chart = Statechart(TestParam())
+        A = HierarchicalState(state_chart, None, None, None)
+        B = HierarchicalState(A, None, None, None)
+        C = State(B, None, None, None)
+        D = State(A, None, None, None)
+        E = State(state_chart, None, None, None)
+
+        self.assertEquals([s.depth for s in (state_chart, A, B, C)], 
+                          [0, 1, 2, 3])
+        self.assertTrue(C.statechart is state_chart)
+
+        t = Transition(C, D, Event(1), None, None)
+        self.assertEquals((t.deactivate, t.activate), ([C, B], [D]))
+
+        t = Transition(E, C, Event(1), None, None)
+        self.assertEquals((t.deactivate, t.activate), ([E], [A, B, C]))
+
+        t = Transition(A, C, Event(2), None, None)
+        self.assertEquals((t.deactivate, t.activate), ([A], [A, B, C]))
+
+        t = Transition(C, A, Event(2), None, None)
+        self.assertEquals((t.deactivate, t.activate), ([C, B, A], [A]))
+
+        t = Transition(B, B, Event(3), None, None)
+        self.assertEquals((t.deactivate, t.activate), ([B], [B]))
+
+class LazySubstatesTest(unittest.TestCase):
+
+    def create_statechart(self, param):
+        state_chart = Statechart(param)
+        start = StartState(state_chart)
+        A = State(state_chart, TestEntryClassAction("A"), None, None)
+        B = HierarchicalState(state_chart, TestEntryClassAction("B"), None,
+                              None)
+        TestTransition(start, 'start', A, 'A', None, None)
+        TestTransition(A, 'A', B, 'B', Event(1), None)
+        TestTransition(B, 'B', A, 'A', Event(2), None)
+
+        def build(B):
+            start_b = StartState(B)
+            C = State(B, TestEntryClassAction("C"), None, None)
+            D = State(B, TestEntryClassAction("D"), None, None)
+            TestTransition(start_b, 'start_b', C, 'C', None, None)
+            TestTransition(C, 'C', D, 'D', Event(3), None)
+
+        B.set_factory(build)
+        return state_chart, B
+
+    def testBuiltOnEntry(self):
+        param = TestParam()
+        state_chart, B = self.create_statechart(param)
+        state_chart.start()
+        self.assertEquals(B.substates, [])
+
+        for event in [3, 1, 3, 2, 1]:
+            state_chart.dispatch(event)
+
+        self.assertEquals(len(B.substates), 3)
+        self.assertEquals(param.path, "start:A A:entry A:B B:entry "
+            "start_b:C C:entry C:D D:entry B:A A:entry A:B B:entry "
+            "start_b:C C:entry")
+
+    def testCompile(self):
+        param = TestParam()
+        state_chart, B = self.create_statechart(param)
+        state_chart.compile()
+        self.assertEquals(len(B.substates), 3)
+
+        state_chart.start()
+        state_chart.dispatch_many([1, 3])
+        self.assertTrue(param.path.endswith("C:D D:entry"))
+
+class LoaderTest(unittest.TestCase):
+
+    description = {
+        "states": [
+            {"name": "start", "type": "start"},
+            {"name": "A", "entry": "A:entry", "states": [
+                {"name": "start_a", "type": "start"},
+                {"name": "history_a", "type": "history"},
+                {"name": "B", "entry": "B:entry"},
+                {"name": "C", "entry": "C:entry"}]},
+            {"name": "X", "type": "concurrent", "states": [
+                {"name": "R1", "states": [
+                    {"name": "start_r1", "type": "start"},
+                    {"name": "D", "entry": "D:entry"}]},
+                {"name": "R2", "states": [
+                    {"name": "start_r2", "type": "start"},
+                    {"name": "E", "entry": "E:entry"}]}]}],
+        "transitions": [
+            {"from": "start", "to": "A"},
+            {"from": "start_a", "to": "history_a"},
+            {"from": "history_a", "to": "B"},
+            {"from": "B", "to": "C", "event": 1, "guard": "yes"},
+            {"from": "A", "to": "X", "event": "go", "action": "A:X"},
+            {"from": "start_r1", "to": "D"},
+            {"from": "start_r2", "to": "E"},
+            {"from": "X", "to": "A", "event": 2}]}
+
+    def create_loader(self, directory=None):
+        from loader import Loader
+
+        actions = dict((name, TestTransitionAction(*name.split(':')))
+                       for name in ["A:entry", "B:entry", "C:entry",
+                                    "D:entry", "E:entry", "A:X"])
+        return Loader(actions, {"yes": TestGuard(True)}, directory)
+
+    def run_chart(self, compiled):
+        instance = compiled.spawn(TestParam())
+        instance.start()
+        instance.dispatch_many([1, "go", 2])
+        return instance.param.path
+
+    def testCachedLoad(self):
+        import shutil
+        import tempfile
+
+        """ C is entered again through the history of A """
+        expected = (" A:entry B:entry C:entry A:X D:entry E:entry A:entry "
+                    "C:entry")
+
+        directory = tempfile.mkdtemp()
+        try:
+            loader = self.create_loader(directory)
+            self.assertEquals(self.run_chart(loader.load(self.description)),
+                              expected)
+
+            loader = self.create_loader(directory)
+            def build(description, param=None):
+                raise AssertionError("Not loaded from the cache")
+            loader.build = build
+            self.assertEquals(self.run_chart(loader.load(self.description)),
+                              expected)
+        finally:
+            shutil.rmtree(directory)
+
+    def testStaleLayout(self):
+        import loader
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        current = loader.layout()
+        try:
+            self.create_loader(directory).load(self.description)
+
+            """ As if the attributes of the states had changed since """
+            loader._layout = "changed"
+            built = []
+            cached = self.create_loader(directory)
+            build = cached.build
+            cached.build = lambda *args: built.append(1) or build(*args)
+            self.assertEquals(self.run_chart(cached.load(self.description)),
+                              " A:entry B:entry C:entry A:X D:entry " +
+                              "E:entry A:entry C:entry")
+            self.assertEquals(built, [1])
+        finally:
+            loader._layout = current
+            shutil.rmtree(directory)
+
+    def testDamagedCache(self):
+        import os
+        import shutil
+        import tempfile
+
+        expected = (" A:entry B:entry C:entry A:X D:entry E:entry A:entry "
+                    "C:entry")
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.create_loader(directory).load(self.description)
+            path = os.path.join(directory, os.listdir(directory)[0])
+            with open(path, 'rb') as input:
+                data = bytearray(input.read())
+
+            """ Any damaged byte gets the statechart built again """
+            for offset in range(0, len(data), 7):
+                damaged = bytearray(data)
+                damaged[offset] ^= 0xff
+                with open(path, 'wb') as output:
+                    output.write(damaged)
+
+                loader = self.create_loader(directory)
+                self.assertEquals(self.run_chart(loader.load(
+                                        self.description)), expected)
+        finally:
+            shutil.rmtree(directory)
+
+    def testErrors(self):
+        from loader import LoaderError
+
+        loader = self.create_loader()
+        self.assertRaises(LoaderError, loader.build, 
+            {"states": [{"name": "A"}, {"name": "A"}]})
+        self.assertRaises(LoaderError, loader.build, 
+            {"states": [{"name": "A"}],
+             "transitions": [{"from": "A", "to": "A", "action": "none"}]})
+
+class TimedTransitionTest(unittest.TestCase):
+
+    def create_statechart(self, param, wheel):
+        from timers import after
+
+        state_chart = Statechart(param)
+        state_chart.set_timing_wheel(wheel)
+        start = StartState(state_chart)
+        A = State(state_chart, TestEntryClassAction("A"), None, None)
+        B = State(state_chart, TestEntryClassAction("B"), None, None)
+        C = State(state_chart, TestEntryClassAction("C"), None, None)
+
+        Transition(start, A, None, None, None)
+        Transition(A, B, after(30), None, None)
+        Transition(B, A, Event(1), None, None)
+        Transition(A, C, Event(2), None, None)
+        return state_chart
+
+    def check(self, compile):
+        from timers import TimingWheel
+        from timers import VirtualClock
+
+        clock = VirtualClock()
+        wheel = TimingWheel(resolution=1, size=8, clock=clock)
+        param = TestParam()
+        state_chart = self.create_statechart(param, wheel)
+        if compile:
+            chart = state_chart.spawn(param)
+        else:
+            chart = state_chart
+
+        chart.start()
+        self.assertEquals(len(wheel), 1)
+
+        clock.advance(29)
+        self.assertEquals(wheel.expire(), 0)
+        clock.advance(1)
+        self.assertEquals(wheel.expire(), 1)
+        self.assertEquals(param.path, "A:entry B:entry")
+
+        chart.dispatch(1)
+        clock.advance(10)
+        wheel.expire()
+        chart.dispatch(2)
+        self.assertEquals(len(wheel), 0)
+
+        clock.advance(100)
+        self.assertEquals(wheel.expire(), 0)
+        self.assertEquals(param.path, "A:entry B:entry A:entry C:entry")
+
+    def testInterpreted(self):
+        self.check(False)
+
+    def testCompiled(self):
+        self.check(True)
+
+    def testStableEvents(self):
+        import pickle
+        from timers import TimingWheel
+        from timers import after
+
+        wheel = TimingWheel()
+        first = self.create_statechart(None, wheel).compile()
+        after(30)
+        after(30)
+        second = self.create_statechart(None, wheel).compile()
+        self.assertEquals(first.snapshots.fingerprint,
+                          second.snapshots.fingerprint)
+
+        event = first.states[2].timeouts[0]
+        self.assertEquals(pickle.loads(pickle.dumps(event)), event)
+
+    def testRestoreArmsTimers(self):
+        from timers import TimingWheel
+        from timers import VirtualClock
+
+        clock = VirtualClock()
+        wheel = TimingWheel(resolution=1, size=8, clock=clock)
+        state_chart = self.create_statechart(None, wheel)
+        compiled = state_chart.compile()
+
+        running = compiled.spawn(TestParam())
+        running.start()
+        snapshot = running.snapshot()
+        running.dispatch(2)
+        self.assertEquals(len(wheel), 0)
+
+        """ Back in A, the timer starts over from the restore """
+        clock.advance(20)
+        running.restore(snapshot)
+        restored = compiled.spawn(TestParam())
+        restored.restore(snapshot)
+        self.assertEquals(len(wheel), 2)
+
+        clock.advance(30)
+        wheel.expire()
+        self.assertEquals(running.param.path, "A:entry C:entry B:entry")
+        self.assertEquals(restored.param.path, "B:entry")
+
+        """ The timers of the states left by the restore are cancelled """
+        running.restore(snapshot)
+        running.dispatch(2)
+        c_snapshot = running.snapshot()
+        restored.restore(snapshot)
+        restored.restore(c_snapshot)
+        self.assertEquals(len(wheel), 0)
+
+    def testJournal(self):
+        import io
+        from journal import Journal
+        from journal import Replay
+        from timers import TimingWheel
+        from timers import VirtualClock
+        from timers import After
+
+        clock = VirtualClock()
+        wheel = TimingWheel(resolution=1, size=8, clock=clock)
+        state_chart = self.create_statechart(None, wheel)
+        compiled = state_chart.compile()
+        instance = compiled.spawn(TestParam())
+        instance.start()
+
+        journal = Journal(io.BytesIO())
+        journal.attach(instance)
+        snapshot = instance.snapshot()
+        offset = journal.mark()
+
+        """ A to B on the timer, back to A, then on to C """
+        clock.advance(30)
+        wheel.expire()
+        journal.dispatch(instance, 1)
+        journal.dispatch(instance, 2)
+        self.assertEquals(instance.param.path,
+                          "A:entry B:entry A:entry C:entry")
+
+        events = [event for event, ids in journal.records(offset)]
+        self.assertTrue(isinstance(events[0], After))
+        self.assertEquals(events, [After(30, (1,)), Event(1), Event(2)])
+
+        replay = Replay(compiled)
+        for actions in (False, True):
+            param = TestParam()
+            runtime = replay.restore(snapshot, journal, offset, param,
+                                     actions)
+            self.assertEquals(compiled.snapshots.snapshot(runtime),
+                              instance.snapshot())
+
+        self.assertEquals(param.path, "B:entry A:entry C:entry")
+
+    def testCachedLoad(self):
+        import shutil
+        import tempfile
+        from timers import TimingWheel
+        from timers import VirtualClock
+
+        description = {
+            "states": [{"name": "start", "type": "start"},
+                       {"name": "A", "entry": "A:entry"},
+                       {"name": "B", "entry": "B:entry"}],
+            "transitions": [{"from": "start", "to": "A"},
+                            {"from": "A", "to": "B", "after": 30}]}
+
+        directory = tempfile.mkdtemp()
+        try:
+            loader = LoaderTest('testCachedLoad').create_loader(directory)
+            loader.load(description)
+            compiled = loader.load(description)
+        finally:
+            shutil.rmtree(directory)
+
+        clock = VirtualClock()
+        wheel = TimingWheel(resolution=1, size=8, clock=clock)
+        compiled.statechart.set_timing_wheel(wheel)
+        instance = compiled.spawn(TestParam())
+        instance.start()
+        clock.advance(30)
+        wheel.expire()
+        self.assertEquals(instance.param.path, " A:entry B:entry")
+
+class AnalysisTest(unittest.TestCase):
+
+    def testProblems(self):
+        from analysis import Analysis
+
+        state_chart = Statechart(TestParam())
+        start = StartState(state_chart)
+        A = HierarchicalState(state_chart, None, None, None)
+        start_a = StartState(A)
+        history_a = HistoryState(A)
+        B = State(A, None, None, None)
+        C = State(A, None, None, None)
+        D = HierarchicalState(state_chart, None, None, None)
+        E = State(D, None, None, None)
+        F = State(state_chart, None, None, None)
+
+        Transition(start, A, None, None, None)
+        Transition(start_a, history_a, None, None, None)
+        Transition(history_a, B, None, None, None)
+        h2 = Transition(history_a, C, None, None, None)
+        t1 = Transition(B, C, Event(1), None, None)
+        t2 = Transition(B, F, Event(1), None, None)
+        t3 = Transition(B, F, Event(1), TestGuard(True), None)
+        Transition(C, B, Event(2), None, None)
+
+        analysis = Analysis(state_chart)
+        self.assertEquals(analysis.missing_start, [D])
+        self.assertEquals([s for s, problem in analysis.history], [history_a])
+        self.assertEquals(analysis.unreachable, [D, E])
+        self.assertEquals(analysis.shadowed, [h2, t2])
+        self.assertEquals(len(analysis.problems()), 6)
+
+        analysis.prune()
+        self.assertEquals(B.get_transitions(Event(1)), [t3, t1])
+
+        """ Analysing again leaves the pruned indexes alone """
+        again = Analysis(state_chart)
+        self.assertEquals(again.shadowed, [h2, t2])
+        self.assertEquals(B.get_transitions(Event(1)), [t3, t1])
+
+class TrustTest(unittest.TestCase):
+
+    def testValidation(self):
+        from analysis import ValidationError
+
+        state_chart = Statechart(TestParam())
+        start = StartState(state_chart)
+        A = HierarchicalState(state_chart, None, None, None)
+        B = State(A, None, None, None)
+        Transition(start, A, None, None, None)
+        self.assertRaises(ValidationError, state_chart.trust)
+
+        StartState(A)
+        state_chart.trust()
+        self.assertRaises(AssertionError, Transition, B, A, Event(1), None,
+                          None)
+
+    def testEmptyStates(self):
+        from analysis import Analysis
+        from analysis import ValidationError
+
+        """ Entered without substates, nothing to start them with """
+        state_chart = Statechart(TestParam())
+        start = StartState(state_chart)
+        X = ConcurrentState(state_chart, None, None, None)
+        R = HierarchicalState(X, None, None, None)
+        H = HierarchicalState(state_chart, None, None, None)
+        I = HierarchicalState(state_chart, None, None, None)
+        Transition(start, X, None, None, None)
+        Transition(X, H, Event(1), None, None)
+
+        self.assertEquals(Analysis(state_chart).missing_start, [R, H])
+        self.assertRaises(ValidationError, state_chart.trust)
+
+class ActiveConfigurationTest(unittest.TestCase):
+
+    def build(self):
+        state_chart = Statechart(TestParam())
+        start = StartState(state_chart)
+        C = ConcurrentState(state_chart, None, None, None)
+        R1 = HierarchicalState(C, None, None, None)
+        R2 = HierarchicalState(C, None, None, None)
+        A = State(R1, None, None, None)
+        B = State(R1, None, None, None)
+        D = State(R2, None, None, None)
+        Transition(start, C, None, None, None)
+        Transition(StartState(R1), A, None, None, None)
+        Transition(StartState(R2), D, None, None, None)
+        Transition(A, B, Event(1), None, None)
+        Transition(B, B, Event(2), None, None)
+        Transition(C, start, Event(3), None, None)
+        return state_chart, C, R1, R2, A, B, D
+
+    def check(self, compile):
+        state_chart, C, R1, R2, A, B, D = self.build()
+        if compile:
+            state_chart.compile()
+        state_chart.start()
+        state_chart.changes()
+
+        self.assertTrue(state_chart.is_in(A) and state_chart.is_in(C))
+        self.assertEqual(set(state_chart.active_leaves()), set([A, D]))
+
+        state_chart.dispatch(1)
+        self.assertFalse(state_chart.is_in(A))
+        self.assertEqual(set(state_chart.active_leaves()), set([B, D]))
+        self.assertEqual(state_chart.changes(), ([A], [B]))
+
+        """ Exited and entered again, no change """
+        state_chart.dispatch(2)
+        self.assertEqual(state_chart.changes(), ([], []))
+
+        """ C is left and entered again, only the leaf of R1 changes """
+        state_chart.dispatch(3)
+        self.assertEqual(state_chart.changes(), ([B], [A]))
+        self.assertEqual(set(state_chart.active_leaves()), set([A, D]))
+
+        """ Raw, every exit and entry in order """
+        state_chart.dispatch(1)
+        state_chart.changes()
+        state_chart.dispatch(2)
+        self.assertEqual(state_chart.changes(raw=True), ([B], [B]))
+
+        state_chart.dispatch(3)
+        self.assertEqual(state_chart.changes(raw=True),
+                         ([B, R1, D, R2, C], [C, R1, A, R2, D]))
+
+    def testInterpreted(self):
+        self.check(False)
+
+    def testCompiled(self):
+        self.check(True)
+
+def process_model():
+    return FSMTest('testSimpleFSM1').create_statechart(None).compile()
+
+def process_param(key):
+    param = TestParam()
+    if key == 1:
+        """ Does not pickle, the instance cannot move """
+        param.callback = lambda: None
+    return param
+
+class ProcessDispatcherTest(unittest.TestCase):
+
+    def testShardingAndRebalance(self):
+        from processes import ProcessDispatcher
+
+        compiled = process_model()
+        events = [1, 8, 4, 5, 2, 5, 6, 4, 7]
+        dispatcher = ProcessDispatcher(process_model, 3, process_param, 4)
+        dispatcher.start()
+        try:
+            keys = range(12)
+            for event in events:
+                dispatcher.dispatch_many([(key, event) for key in keys])
+
+            """ All the instances on one worker, then spread again """
+            self.assertEquals(dispatcher.move(keys, 0), 7)
+            self.assertTrue(1 in dispatcher.keys()[1])
+            self.assertEquals(dispatcher.rebalance(), 7)
+            self.assertEquals(sorted(map(len, dispatcher.keys())), [4, 4, 4])
+
+            for event in [1, 2]:
+                dispatcher.dispatch_many([(key, event) for key in keys])
+            dispatcher.join()
+
+            expected = compiled.spawn(TestParam())
+            expected.start()
+            for event in events + [1, 2]:
+                expected.dispatch(event)
+
+            """ The paths the actions wrote moved with the instances """
+            self.assertEquals(dispatcher.failures, [])
+            for key in keys:
+                self.assertEquals(dispatcher.snapshot(key),
+                                  expected.snapshot())
+                if key != 1:
+                    self.assertEquals(dispatcher.instance_param(key).path,
+                                      expected.param.path)
+        finally:
+            dispatcher.stop()
+
 if __name__ == "__main__":
     unittest.main()    
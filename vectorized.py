@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+__author__      = "Vishal Patil"
+__copyright__   = "Copyright 2010 - 2011, Vishal Patil"
+__license__     = "New-style BSD"
+
+from array import array
+
+import numpy
+
+from compiled import HIERARCHICAL
+from compiled import CONCURRENT
+from compiled import START
+from compiled import HISTORY
+from transition import Event
+
+""" Values of the next leaf table besides the state ids """
+NOT_HANDLED     = -1
+FALLBACK        = -2
+
+""" Leaf of the instances that are run by the CompiledStatechart """
+INTERPRETED     = -1
+
+class VectorizedStatechart(object):
+
+    """
+        Runs one compiled statechart for a large number of instances. The
+        configuration of an instance is its deepest active state, kept in an
+        integer array together with its history records. Transitions whose
+        outcome only depends on that state, that is the ones without guards,
+        actions or entry/exit actions, which do not enter history or
+        concurrent states, are applied to all the instances at once through
+        table lookups. The other instances are dispatched one by one by the
+        CompiledStatechart, an instance that ends up in a concurrent state
+        stays with the CompiledStatechart.
+    """
+
+    def __init__(self, compiled, count, params=None):
+        self.compiled = compiled
+        self.count = count
+        self.params = params
+
+        states = compiled.states
+        self.depths = [state.depth for state in states]
+
+        """ Event id to table column, the last column is for other events """
+        self.columns = {}
+        for table in compiled.tables:
+            for key in table:
+                if key not in self.columns:
+                    self.columns[key] = len(self.columns)
+        self.other = len(self.columns)
+
+        self.compile_tables()
+
+        self.leaves = numpy.zeros(count, dtype=numpy.int32)
+        self.history = numpy.empty((count, len(compiled.history_states)),
+                                   dtype=numpy.int32)
+        self.history.fill(-1)
+        self.runtimes = {}
+
+    def compile_tables(self):
+        compiled = self.compiled
+        shape = (len(compiled.states), self.other + 1)
+
+        self.next_leaf = numpy.empty(shape, dtype=numpy.int32)
+        self.next_leaf.fill(NOT_HANDLED)
+        self.fired = numpy.empty(shape, dtype=numpy.int32)
+        self.fired.fill(-1)
+
+        """ Per history state, the state recorded by a table transition """
+        self.history_writes = []
+        for history_state in compiled.history_states:
+            writes = numpy.empty(shape, dtype=numpy.int32)
+            writes.fill(-1)
+            self.history_writes.append(writes)
+
+        keys = [None] * (self.other + 1)
+        for key, column in self.columns.items():
+            keys[column] = key
+
+        for state in compiled.states:
+            id = state.state_id
+            kind = compiled.kinds[id]
+
+            if (kind == CONCURRENT or
+                (kind == HIERARCHICAL and state.start_state)):
+                self.next_leaf[id].fill(FALLBACK)
+                continue
+
+            for column in range(self.other + 1):
+                if column == self.other:
+                    candidates = compiled.eventless[id]
+                else:
+                    candidates = compiled.tables[id].get(keys[column],
+                                        compiled.eventless[id])
+
+                if not candidates:
+                    continue
+
+                transition = candidates[0]
+                result = self.resolve(state, transition)
+                if result == None:
+                    self.next_leaf[id, column] = FALLBACK
+                    continue
+
+                leaf, writes = result
+                self.next_leaf[id, column] = leaf
+                self.fired[id, column] = transition.id
+                for index, value in writes:
+                    self.history_writes[index][id, column] = value
+
+    def resolve(self, state, transition):
+        """
+            Returns the new deepest state and the history records written
+            when the transition fires in state, None if the outcome is not
+            static.
+        """
+        compiled = self.compiled
+        kinds = compiled.kinds
+
+        if transition.guard or transition.action or not transition.exits:
+            return None
+
+        writes = []
+        top = transition.exits[-1]
+        child = None
+        while state is not top:
+            if not self.resolve_exit(state, child, writes):
+                return None
+
+            child = state
+            state = state.context
+            if state == None:
+                return None
+
+        if not self.resolve_exit(state, child, writes):
+            return None
+
+        leaf = self.resolve_entry(transition)
+        if leaf == None:
+            return None
+
+        return (leaf, writes)
+
+    def resolve_exit(self, state, child, writes):
+        kind = self.compiled.kinds[state.state_id]
+
+        if kind == CONCURRENT or state.exit:
+            return False
+
+        if kind == HIERARCHICAL and state.history:
+            index = self.compiled.histories[state.history.state_id]
+            if child == None:
+                writes.append((index, -1))
+            else:
+                writes.append((index, child.state_id))
+
+        return True
+
+    def resolve_entry(self, transition):
+        kinds = self.compiled.kinds
+        leaf = None
+
+        for state in transition.enters:
+            kind = kinds[state.state_id]
+            if kind == CONCURRENT or kind == START or kind == HISTORY:
+                return None
+
+            if state.entry or state.do:
+                return None
+
+            leaf = state.state_id
+
+        if transition.initial:
+            initials = self.compiled.initials[transition.initial.state_id]
+            if not initials:
+                return leaf
+
+            initial = initials[0]
+            if (initial.guard or initial.action or
+                initial.exits != (transition.initial,)):
+                return None
+
+            return self.resolve_entry(initial)
+
+        return leaf
+
+    def param(self, instance):
+        if self.params == None:
+            return None
+
+        return self.params[instance]
+
+    def restore_runtime(self, instance):
+        """ Builds the runtime data of an instance kept in the arrays """
+        compiled = self.compiled
+        runtime = compiled.new_runtime()
+
+        path = []
+        id = self.leaves[instance]
+        while id != -1:
+            path.append(compiled.states[id])
+            id = compiled.parents[id]
+
+        for state in reversed(path):
+            runtime.activate(state)
+
+        typecode = runtime.history.typecode
+        runtime.history[:] = array(typecode, self.history[instance].tolist())
+        return runtime
+
+    def store_runtime(self, instance, runtime):
+        """ Moves an instance back to the arrays if it is a single chain """
+        compiled = self.compiled
+        leaf = runtime.leaves[0]
+
+        chain = (compiled.kinds[leaf] != CONCURRENT and
+                 sum(runtime.active) == self.depths[leaf] + 1)
+
+        id = leaf
+        while chain and id != -1:
+            chain = runtime.active[id] == 1
+            id = compiled.parents[id]
+
+        if chain:
+            self.leaves[instance] = leaf
+            self.history[instance] = runtime.history.tolist()
+            self.runtimes.pop(instance, None)
+        else:
+            self.leaves[instance] = INTERPRETED
+            self.runtimes[instance] = runtime
+
+    def start(self):
+        compiled = self.compiled
+        self.runtimes.clear()
+        self.history.fill(-1)
+
+        start_state = compiled.statechart.start_state
+        initials = compiled.initials[start_state.state_id]
+        leaf = None
+        if initials and not initials[0].guard:
+            leaf = self.resolve_entry(initials[0])
+
+        if leaf != None and not initials[0].action:
+            self.leaves.fill(leaf)
+            return
+
+        for instance in range(self.count):
+            runtime = compiled.new_runtime()
+            compiled.start(runtime, self.param(instance))
+            self.store_runtime(instance, runtime)
+
+    def dispatch_one(self, instance, event_id):
+        if self.leaves[instance] == INTERPRETED:
+            runtime = self.runtimes[instance]
+        else:
+            runtime = self.restore_runtime(instance)
+
+        id = self.compiled.dispatch(runtime, Event.get(event_id),
+                                    self.param(instance))
+        self.store_runtime(instance, runtime)
+        return id
+
+    def dispatch(self, instances, events):
+        """
+            Dispatches events[i] to instances[i], an instance may appear more
+            than once and gets its events in order. Returns an array with
+            the id of the transition fired for every event or -1.
+        """
+        instances = numpy.asarray(instances)
+        events = numpy.asarray(events)
+        results = numpy.empty(len(instances), dtype=numpy.int32)
+        results.fill(-1)
+
+        uniques, inverse = numpy.unique(events, return_inverse=True)
+        columns = numpy.array([self.columns.get(key, self.other)
+                               for key in uniques.tolist()], dtype=numpy.int32)
+        columns = columns[inverse]
+
+        pending = numpy.arange(len(instances))
+        while len(pending):
+            """ Events of the same instance are handled in separate rounds """
+            dummy, first = numpy.unique(instances[pending], return_index=True)
+            first.sort()
+            current = pending[first]
+            pending = numpy.delete(pending, first)
+
+            self.dispatch_round(current, instances, events, columns, results)
+
+        return results
+
+    def dispatch_round(self, positions, instances, events, columns, results):
+        targets = instances[positions]
+        leaves = self.leaves[targets]
+
+        tabled = leaves != INTERPRETED
+        rows = numpy.where(tabled, leaves, 0)
+        cols = columns[positions]
+        next_leaf = numpy.where(tabled, self.next_leaf[rows, cols], FALLBACK)
+
+        fast = next_leaf >= 0
+        fast_targets = targets[fast]
+        fast_rows = rows[fast]
+        fast_cols = cols[fast]
+
+        for index, writes in enumerate(self.history_writes):
+            values = writes[fast_rows, fast_cols]
+            recorded = values >= 0
+            self.history[fast_targets[recorded], index] = values[recorded]
+
+        self.leaves[fast_targets] = next_leaf[fast]
+        results[positions[fast]] = self.fired[fast_rows, fast_cols]
+
+        for position in positions[next_leaf == FALLBACK].tolist():
+            results[position] = self.dispatch_one(int(instances[position]),
+                                                  events[position].item())